@@ -1,5 +1,6 @@
 # if we run pyinstaller build for linux, we have to extend LD_LIBRARY_PATH with goosli dependencies
 import logging
+import multiprocessing
 import os
 import sys
 from pathlib import Path
@@ -52,6 +53,8 @@ def excepthook(exc_type, exc_value, exc_tb):
 
 
 if __name__ == "__main__":
+    # G-code is parsed in worker processes, they must not start the app in bundles
+    multiprocessing.freeze_support()
     load_settings()
 
     app = QApplication(sys.argv)
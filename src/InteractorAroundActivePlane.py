@@ -117,7 +117,7 @@ class InteractionAroundActivePlane:
                 view.model_centering()
                 view.save_current_movement()
 
-    def middleBtnPress(self, obj, event):
+    def middleBtnPress(self, obj, event, view=None):
         if event == "MouseWheelForwardEvent":
             self.distanceToFocal -= 0.1 * self.distanceToFocal
             # we block the minimal distance to focal point
@@ -127,6 +127,8 @@ class InteractionAroundActivePlane:
 
         self.pos = unit(self.pos) * self.distanceToFocal
         self.render.GetActiveCamera().SetPosition(*self.pos[:3])
+        if view:
+            view.update_gcode_detail(self.distanceToFocal)
         self.interactor.ReInitialize()
 
     def rightBtnPress(self, obj, event):
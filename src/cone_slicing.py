@@ -2,6 +2,12 @@
 Module contains logic behind the cone slicing
 """
 
+import itertools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from typing import Tuple
 
 import numpy as np
@@ -9,6 +15,8 @@ from stl import mesh
 
 from src.settings import sett
 
+logger = logging.getLogger(__name__)
+
 
 def load_mesh(filename: str) -> mesh:
     # TODO: we should take already loaded mesh object, because it might be rotated or translated
@@ -20,6 +28,17 @@ def load_mesh(filename: str) -> mesh:
     return model
 
 
+# edge-layer pairs solved at once, bounds memory of the batched solve
+CROSS_BATCH_SIZE = 1 << 20
+
+# smaller meshes are cut in one process, starting workers costs more
+CONE_PARALLEL_MIN_TRIANGLES = 1 << 16
+
+# ends of segments closer than this are welded into one contour point, mm
+STITCH_TOLERANCE = 1e-6
+_NEIGHBOUR_CELLS = [o for o in itertools.product((-1, 0, 1), repeat=3) if any(o)]
+
+
 def cross_stl(mesh_input: mesh.Mesh, cone: Tuple[float, Tuple[float, float, float]]):
     """
     Intersection lines of stl model and cone surface
@@ -38,38 +57,467 @@ def cross_stl(mesh_input: mesh.Mesh, cone: Tuple[float, Tuple[float, float, floa
     cone[0] - cone angle in degrees
     cone[1] - vertex of the cone: [x, y, z]
 
-    Function returns a List of paths for each layer
+    Layers go up from the vertex until cones no longer reach the model, they
+    are spaced by slicing.layer_height or by the local slope of the surface
+    when slicing.cone_adaptive_layers is set, see adaptive_cone_heights
+
+    Function returns a List of (k, 2, 3) arrays of intersection segments for each layer
     """
     s = sett()
-    layers = []
-    vertex = [*cone[1]]
-    starting_height = vertex[2]
-    # update function to return layers
-    for layer_idx in range(100):
-        cross_p_list = []
-        vertex[2] = starting_height + s.slicing.layer_height * layer_idx
-        for triangle in mesh_input:
-            t = [triangle[:3], triangle[3:6], triangle[6:9]]
-
-            points = []
-            for x, y in ((t[0], t[1]), (t[0], t[2]), (t[1], t[2])):
-                cross_p = cone_cross(
-                    x, y, cone[0], np.array(vertex)
-                )  # find cross point(s) of line and cone
-                if cross_p:
-                    if len(cross_p) == 3:  # one intersection point of line and cone
-                        if cross_p not in points:
-                            points.append(cross_p)
-                        elif (
-                            len(cross_p) == 2
-                        ):  # two intersection points of line and cone
-                            points = cross_p
-                        if len(points) in [2, 4, 6]:
-                            cross_p_list.append(points)  # add intersection lines
-
-        layers.append(cross_p_list)
-    return layers
-    # return cross_p_list  # example: array([[[ 2. , -0.7, 20. ], [ 2. , -0.7, 20. ]], [[ 1.6, -1.3, 20. ], [ 1.7, -1.3, 20. ]]])
+    angle, vertex = cone
+    triangles = np.asarray(getattr(mesh_input, "vectors", mesh_input))
+    spans = cone_spans(triangles, angle, vertex)
+    if s.slicing.cone_adaptive_layers:
+        heights = adaptive_cone_heights(
+            triangles,
+            angle,
+            vertex,
+            s.slicing.cone_min_layer_height,
+            s.slicing.cone_max_layer_height,
+            spans,
+        )
+    else:
+        heights = cone_heights(spans, vertex[2], s.slicing.layer_height)
+
+    processes = s.slicing.cone_processes or None
+    return cross_cone_layers_parallel(
+        triangles, angle, vertex, heights, processes, spans=spans
+    )
+
+
+def cone_heights(spans, start, step):
+    """
+    Evenly spaced cone vertex heights from start up to the top of the model
+
+    spans - ranges of vertex heights of cones cutting triangles, see cone_spans
+    """
+    top = spans[1].max(initial=-np.inf)
+    count = int(np.floor((top - start) / step)) + 1 if top >= start else 0
+    return start + step * np.arange(count)
+
+
+def adaptive_cone_heights(triangles, angle, vertex, min_height, max_height, spans=None):
+    """
+    Cone vertex heights spaced by the slope of the surface
+
+    A layer of a thickness t leaves a cusp of t * |cos| on a surface, where cos
+    is between the normals of the surface and of the cone layer. Every
+    triangle allows the step which keeps its cusp within min_height, limited
+    to [min_height, max_height]: surfaces along the layers get the thinnest
+    layers, surfaces across them the thickest. The step at every height is
+    the smallest one of triangles cut there.
+
+    Returns heights from the vertex up to the top of the model
+    """
+    triangles = np.asarray(triangles).reshape(-1, 3, 3)
+    if spans is None:
+        spans = cone_spans(triangles, angle, vertex)
+    lowest, highest = spans
+    start = vertex[2]
+    top = highest.max(initial=-np.inf)
+    if top < start:
+        return np.empty(0)
+
+    # the smallest step of triangles in bins of min_height along heights
+    bins = int((top - start) // min_height) + 1
+    first = np.clip((lowest - start) // min_height, 0, bins).astype(np.int64)
+    last = np.clip((highest - start) // min_height + 1, 0, bins).astype(np.int64)
+    count = np.maximum(last - first, 0)
+    tri_idx = np.repeat(np.arange(len(count)), count)
+    offsets = np.cumsum(count) - count
+    bin_idx = np.arange(len(tri_idx)) - np.repeat(offsets, count) + first[tri_idx]
+
+    steps = _slope_steps(triangles, angle, vertex, min_height, max_height)
+    bin_steps = np.full(bins, float(max_height))
+    np.minimum.at(bin_steps, bin_idx, steps[tri_idx])
+
+    heights, height = [], start
+    while height <= top:
+        heights.append(height)
+        # a step covers bins up to its end, none of them may need a smaller one
+        i = int((height - start) // min_height)
+        step = bin_steps[i]
+        step = bin_steps[i : int((height + step - start) // min_height) + 1].min()
+        height += step
+    return np.array(heights)
+
+
+def _slope_steps(triangles, angle, vertex, min_height, max_height):
+    # steps of cone layers which keep the cusp of every triangle in min_height
+    tri = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+    normal = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+    radial = tri[:, :, :2].mean(axis=1) - np.asarray(vertex[:2], dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normal /= np.linalg.norm(normal, axis=1)[:, None]
+        radial /= np.linalg.norm(radial, axis=1)[:, None]
+
+        # normal of the cone layer is tilted from Z towards the radius
+        alpha = np.radians(angle)
+        along = np.sum(normal[:, :2] * radial, axis=1)
+        cos = np.abs(
+            np.cos(alpha) * np.nan_to_num(along) + np.sin(alpha) * normal[:, 2]
+        )
+        steps = min_height / cos
+    return np.clip(np.nan_to_num(steps, nan=max_height), min_height, max_height)
+
+
+def cone_contours(mesh_input: mesh.Mesh, cone, tolerance=STITCH_TOLERANCE):
+    """
+    Ordered contours of stl model cut by cone surfaces, see cross_stl
+
+    Returns a list of (loops, chains) for each layer, as in stitch_loops
+    """
+    contours = [
+        stitch_loops(segments, tolerance) for segments in cross_stl(mesh_input, cone)
+    ]
+    for layer, (_, chains) in enumerate(contours):
+        if chains:
+            logger.warning("%d open contours at cone layer %d", len(chains), layer)
+    return contours
+
+
+def stitch_loops(segments, tolerance=STITCH_TOLERANCE):
+    """
+    Ordered contours from unordered segments of one layer
+
+    segments - (k, 2, 3) array of segment ends
+    tolerance - ends closer than this are taken as the same point
+
+    Ends are welded by a hash map of grid cells of the tolerance size, so the
+    cost grows linearly with the number of segments. Then contours are walked
+    from segment to segment through their shared ends.
+
+    Returns a list of closed loops and a list of open chains, both as (m, 3)
+    arrays of points; a closed loop ends with its first point
+    """
+    segments = np.asarray(segments, dtype=np.float64).reshape(-1, 2, 3)
+    points = segments.reshape(-1, 3)
+    ids = _weld_ends(points, tolerance)
+    positions = np.empty((ids.max() + 1 if len(ids) else 0, 3))
+    positions[ids] = points
+
+    ends = ids.reshape(-1, 2)
+    ends = ends[ends[:, 0] != ends[:, 1]]  # segments shorter than tolerance
+
+    # segments at every point, in the CSR layout
+    order = np.argsort(ends.ravel(), kind="stable")
+    bounds = np.searchsorted(ends.ravel()[order], np.arange(len(positions) + 1))
+    degree = np.diff(bounds)
+
+    incident, ends = (order // 2).tolist(), ends.tolist()
+    cursor, bounds = bounds[:-1].tolist(), bounds[1:].tolist()
+    used = [False] * len(ends)
+
+    def walk(node):
+        path = [node]
+        while True:
+            while cursor[node] < bounds[node] and used[incident[cursor[node]]]:
+                cursor[node] += 1
+            if cursor[node] == bounds[node]:
+                return path
+            segment = incident[cursor[node]]
+            used[segment] = True
+            first, second = ends[segment]
+            node = second if first == node else first
+            path.append(node)
+
+    loops, chains = [], []
+    # open chains start at dangling ends, everything left is closed
+    for node in np.flatnonzero(degree % 2).tolist():
+        if cursor[node] < bounds[node]:
+            path = walk(node)
+            if len(path) > 1:
+                chains.append(positions[path])
+    for segment, (node, _) in enumerate(ends):
+        if not used[segment]:
+            loops.append(positions[walk(node)])
+    return loops, chains
+
+
+def _weld_ends(points, tolerance):
+    # ids of points, those closer than tolerance share one
+    cells = np.floor(points / tolerance).astype(np.int64).tolist()
+    table = {}
+    ids = [table.setdefault(tuple(cell), len(table)) for cell in cells]
+    ids = np.array(ids, dtype=np.int64)
+
+    # ends next to a cell border may fall into the cell next to their pair,
+    # a contour passes every point twice, so such cells hold odd counts
+    count = np.bincount(ids, minlength=len(table))
+    positions = np.empty((len(table), 3))
+    positions[ids] = points
+    remap = np.arange(len(table))
+    for i in np.flatnonzero(count[ids] % 2).tolist():
+        node = ids[i]
+        if count[node] % 2 == 0:
+            continue
+        for offset in _NEIGHBOUR_CELLS:
+            cell = tuple(c + o for c, o in zip(cells[i], offset))
+            other = table.get(cell)
+            if other is None or count[other] % 2 == 0:
+                continue
+            if np.linalg.norm(positions[other] - points[i]) <= tolerance:
+                remap[other] = node
+                count[node] += count[other]
+                count[other] = 0
+                break
+
+    # welded cells may be welded again, follow them to the last one
+    while (remap[remap] != remap).any():
+        remap = remap[remap]
+    return remap[ids]
+
+
+def cross_cone_layers(triangles, angle, vertex, heights, spans=None):
+    """
+    Intersection segments of triangles and cones which differ by vertex height
+
+    triangles - (n, 3, 3) or (n, 9) array of triangle vertices
+    angle - cone angle in degrees, as in cone_cross
+    vertex - vertex of the cone: [x, y, z], its z is replaced by every height
+    heights - z of the cone vertex of every layer
+
+    Every triangle is only tried with cones whose vertex heights are within
+    its span, edges of these are intersected with the lower nappe of the cone
+    by batched quadratic solves. Points where the cone crosses the border of a
+    triangle are paired into segments which cut off the parts of the triangle
+    outside the cone, so a triangle gives up to three segments.
+
+    spans - result of cone_spans for these triangles, to skip finding it again
+
+    Returns a list with a (k, 2, 3) array of segments for every height
+    """
+    triangles = np.asarray(triangles).reshape(-1, 3, 3)
+    heights = np.asarray(heights, dtype=np.float64)
+    if spans is None:
+        spans = cone_spans(triangles, angle, vertex)
+    tri_idx, layer_idx = _layer_candidates(spans, heights)
+    found = _cross_candidates(triangles, angle, vertex, heights, tri_idx, layer_idx)
+    return _split_layers(*found, len(heights))
+
+
+def cross_cone_layers_parallel(
+    triangles,
+    angle,
+    vertex,
+    heights,
+    processes=None,
+    min_triangles=CONE_PARALLEL_MIN_TRIANGLES,
+    spans=None,
+):
+    """
+    Run cross_cone_layers in a pool of processes
+
+    The triangles are put into shared memory once, then workers cut disjoint
+    ranges of layers with about the same number of candidate triangles each,
+    reading the mesh from there without copying it. Meshes with less than
+    min_triangles are cut in this process
+    """
+    processes = processes or os.cpu_count() or 1
+    triangles = np.asarray(triangles).reshape(-1, 3, 3)
+    if processes == 1 or len(triangles) < min_triangles:
+        return cross_cone_layers(triangles, angle, vertex, heights, spans)
+
+    heights = np.asarray(heights, dtype=np.float64)
+    if spans is None:
+        spans = cone_spans(triangles, angle, vertex)
+    tri_idx, layer_idx = _layer_candidates(spans, heights)
+    order = np.argsort(layer_idx, kind="stable")
+    tri_idx, layer_idx = tri_idx[order], layer_idx[order]
+
+    # ranges end at layer borders, several per process to even out the load
+    chunks = processes * 4
+    cuts = np.searchsorted(layer_idx, np.arange(len(heights) + 1))
+    targets = np.linspace(0, len(layer_idx), chunks + 1)
+    bounds = np.unique(cuts[np.searchsorted(cuts, targets)])
+
+    shm = shared_memory.SharedMemory(create=True, size=max(triangles.nbytes, 1))
+    try:
+        np.ndarray(triangles.shape, triangles.dtype, buffer=shm.buf)[:] = triangles
+        # the app runs other threads, forking it might copy their held locks
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+            count = len(bounds) - 1
+            found = list(
+                executor.map(
+                    _cross_shared,
+                    [shm.name] * count,
+                    [triangles.shape] * count,
+                    [triangles.dtype.str] * count,
+                    [angle] * count,
+                    [vertex] * count,
+                    [heights] * count,
+                    [tri_idx[s:e] for s, e in zip(bounds[:-1], bounds[1:])],
+                    [layer_idx[s:e] for s, e in zip(bounds[:-1], bounds[1:])],
+                )
+            )
+    finally:
+        shm.close()
+        shm.unlink()
+
+    segments = np.concatenate([np.empty((0, 2, 3))] + [f[0] for f in found])
+    layers = np.concatenate([np.empty(0, dtype=np.int64)] + [f[1] for f in found])
+    return _split_layers(segments, layers, len(heights))
+
+
+def _cross_shared(name, shape, dtype, angle, vertex, heights, tri_idx, layer_idx):
+    # runs in a worker process, the mesh is read from the shared memory block
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        triangles = np.ndarray(shape, dtype, buffer=shm.buf)
+        found = _cross_candidates(triangles, angle, vertex, heights, tri_idx, layer_idx)
+        del triangles  # the buffer can not be closed while it is viewed
+        return found
+    finally:
+        shm.close()
+
+
+def _cross_candidates(triangles, angle, vertex, heights, tri_idx, layer_idx):
+    """
+    Segments of the candidate pairs of triangles and layers
+
+    Edge terms are only found for triangles which are candidates at all.
+
+    Returns (k, 2, 3) array of segments and (k) array of their layers
+    """
+    used, local = np.unique(tri_idx, return_inverse=True)
+    edges = _cone_edges(triangles[used], angle, vertex)
+
+    segments, layers = [np.empty((0, 2, 3))], [np.empty(0, dtype=np.int64)]
+    for start in range(0, len(local), CROSS_BATCH_SIZE):
+        batch = slice(start, start + CROSS_BATCH_SIZE)
+        found, pairs = _cross_pairs(edges, local[batch], heights[layer_idx[batch]])
+        segments.append(found)
+        layers.append(layer_idx[batch][pairs])
+    return np.concatenate(segments), np.concatenate(layers)
+
+
+def cone_spans(triangles, angle, vertex):
+    """
+    Range of cone vertex heights at which cones may cut every triangle
+
+    A cone passes through a point when its vertex is the cone radius above
+    the point, so it can only cut a triangle between the lowest and the
+    highest of these heights. The highest is at a triangle vertex, the lowest
+    is bounded as no point is closer to the axis than the nearest vertex less
+    the longest edge. For a plane (angle of 90 degrees) the range is the Z
+    span of the triangle.
+
+    Returns (n) arrays of the lowest and the highest vertex heights
+    """
+    # (3, n) rows of vertex coordinates, reductions over them are faster
+    tri = np.asarray(triangles).reshape(-1, 3, 3).transpose(2, 1, 0)
+    x, y, z = np.array(tri, dtype=np.float64, order="C")
+
+    ctg = 1 / np.tan(np.radians(angle))
+    reach = np.hypot(x - vertex[0], y - vertex[1]) * ctg
+    side = np.hypot(x - np.roll(x, -1, axis=0), y - np.roll(y, -1, axis=0))
+    near = np.minimum.reduce(reach) - np.maximum.reduce(side) * ctg
+    lowest = np.minimum.reduce(z) + np.maximum(near, 0)
+    return lowest, np.maximum.reduce(z + reach)
+
+
+def _layer_candidates(spans, heights):
+    """
+    Pairs of triangles and layers whose cones may cut the triangles
+
+    Triangles are ranged by the sorted heights, so the work grows with the
+    number of candidates rather than with layers times triangles.
+
+    Returns (m) arrays of triangle and layer indices
+    """
+    lowest, highest = spans
+    order = np.argsort(heights, kind="stable")
+    first = np.searchsorted(heights[order], lowest, side="left")
+    count = np.searchsorted(heights[order], highest, side="right") - first
+    count = np.maximum(count, 0)
+
+    tri_idx = np.repeat(np.arange(len(count)), count)
+    offsets = np.cumsum(count) - count
+    rank = np.arange(len(tri_idx)) - np.repeat(offsets, count) + first[tri_idx]
+    return tri_idx, order[rank]
+
+
+def _split_layers(segments, layers, count):
+    # list of segments of every layer from segments with their layer indices
+    order = np.argsort(layers, kind="stable")
+    bounds = np.cumsum(np.bincount(layers, minlength=count))[:-1]
+    return np.split(segments[order], bounds)
+
+
+def _cone_edges(triangles, angle, vertex):
+    # terms of edge-cone equations which do not depend on the vertex height
+    tri = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+    starts = tri
+    directions = np.roll(tri, -1, axis=1) - tri  # edges v0-v1, v1-v2, v2-v0
+
+    ctg = 1 / np.tan(np.radians(angle))
+    ctg2 = ctg**2
+    q = starts[..., :2] - np.asarray(vertex[:2], dtype=np.float64)
+    d = directions
+    a = d[..., 2] ** 2 - (d[..., 0] ** 2 + d[..., 1] ** 2) * ctg2
+    b = -2 * (d[..., 0] * q[..., 0] + d[..., 1] * q[..., 1]) * ctg2
+    c = -(q[..., 0] ** 2 + q[..., 1] ** 2) * ctg2
+
+    # cone radius of the first vertex in terms of height, to find its side
+    reach = np.hypot(q[:, 0, 0], q[:, 0, 1]) * ctg
+    return starts, directions, a, b, c, reach
+
+
+def _cross_pairs(edges, tri_idx, heights):
+    """
+    Segments of triangles tri_idx cut by cones with vertices at heights
+
+    Returns (k, 2, 3) array of segments and (k) array of indices of the pairs
+    of triangles and heights they come from
+    """
+    starts, directions, a, b, c, reach = edges
+    dz = directions[tri_idx, :, 2]
+    qz = starts[tri_idx, :, 2] - heights[:, None]
+
+    a = a[tri_idx]
+    b = 2 * dz * qz + b[tri_idx]
+    c = qz**2 + c[tri_idx]
+    disc = b**2 - 4 * a * c
+
+    # numerically stable roots, they also hold when a is close to zero
+    with np.errstate(divide="ignore", invalid="ignore"):
+        root = -0.5 * (b + np.copysign(np.sqrt(disc), b))
+        lam = np.stack([root / a, c / root], axis=-1)  # (m, 3, 2)
+
+        # the border is half open at every edge end, so vertices count once,
+        # only the lower nappe of the cone is taken
+        valid = (lam >= 0) & (lam < 1) & (qz[..., None] + lam * dz[..., None] <= 0)
+    valid = valid.reshape(-1, 6)
+    count = valid.sum(axis=1)
+
+    # most pairs miss the cone, points are found only for the others
+    rows = np.flatnonzero(count >= 2)
+    count, valid = count[rows], valid[rows]
+    lam = np.where(valid, lam[rows].reshape(-1, 6), 0)
+    tri_idx, heights = tri_idx[rows], heights[rows]
+    p, d = starts[tri_idx], directions[tri_idx]
+    points = p[:, :, None, :] + lam.reshape(-1, 3, 2, 1) * d[:, :, None, :]
+
+    param = np.where(valid, np.repeat(np.arange(3), 2) + lam, np.inf)
+    order = np.argsort(param, axis=1)
+    points = np.take_along_axis(points.reshape(-1, 6, 3), order[..., None], axis=1)
+
+    # the border alternates between the inside and the outside of the cone,
+    # segments pair ends of outside arcs, the first one ends at the first
+    # point when the first vertex is outside
+    outside = reach[tri_idx] > heights - p[:, 0, 2]
+    shift = outside.astype(np.int64)
+
+    segments, pairs = [], []
+    for j in range(3):
+        found = np.flatnonzero((count > 2 * j) & (count % 2 == 0))
+        n = count[found]
+        start = (2 * j + shift[found]) % n
+        end = (2 * j + 1 + shift[found]) % n
+        segments.append(np.stack([points[found, start], points[found, end]], axis=1))
+        pairs.append(rows[found])
+    return np.concatenate(segments), np.concatenate(pairs)
 
 
 def cone_cross(p_1, p_2, alpha_cone=10.0, p_cone=np.array([0.0, 0.0, 0.0])):
@@ -15,7 +15,7 @@ from PyQt5.QtCore import QUrl
 from PyQt5.QtWidgets import QFileDialog, QInputDialog, QMessageBox
 from PyQt5.QtGui import QDesktopServices
 
-from src import gui_utils, locales, qt_utils
+from src import gcode, gui_utils, locales, qt_utils
 from src.figure_editor import PlaneEditor, ConeEditor
 from src.gui_utils import (
     showErrorDialog,
@@ -42,6 +42,9 @@ from .file_management import FileManagementMixin
 
 logger = logging.getLogger(__name__)
 
+# part of the G-code loading progress taken by parsing, the rest is geometry
+GCODE_PARSED_PERCENT = 50
+
 try:
     from src.bug_report import bugReportDialog
 except Exception:
@@ -375,19 +378,13 @@ class MainController(FileManagementMixin):
         if self.view.picture_slider.value() == self.model.current_slider_value:
             return
 
-        step = (
-            1
-            if self.view.picture_slider.value() > self.model.current_slider_value
-            else -1
+        # the view jumps right to the value instead of stepping through layers
+        self.model.current_slider_value = self.view.change_layer_view(
+            self.view.picture_slider.value(),
+            self.model.current_slider_value,
+            self.model.gcode,
         )
 
-        for i in range(
-            self.model.current_slider_value, self.view.picture_slider.value(), step
-        ):
-            self.model.current_slider_value = self.view.change_layer_view(
-                i + step, self.model.current_slider_value, self.model.gcode
-            )
-
         self.view.reload_scene()
         self.view.hide_checkbox.setChecked(True)
         self.view.model_switch_box.setChecked(False)
@@ -481,31 +478,80 @@ class MainController(FileManagementMixin):
         self.view.hide_checkbox.setChecked(True)
         self.view._recreate_splanes(self.model.splanes)
 
-    def load_gcode(self, filename, is_from_stl):
-        def work():
-            logger.info("start parsing gcode")
-            start_time = time.time()
-            gc = self.model.load_gcode(filename)
-            logger.info("finish parsing gcode")
-            end_time = time.time()
-            logger.info("spent time for gcode loading: %s s", end_time - start_time)
+    def load_gcode(self, filename, is_from_stl, gc=None):
+        # geometry of the whole print is simplified when seen from afar
+        level = gui_utils.lodLevel(self.view.customInteractor.distanceToFocal)
+        groups = []
+
+        def work(report):
+            if gc is None:
+                size = max(os.path.getsize(filename), 1)
+
+                def parsed(offset):
+                    report(GCODE_PARSED_PERCENT * offset / size)
+
+                logger.info("start parsing gcode")
+                start_time = time.time()
+                loaded = self.model.load_gcode(filename, parsed)
+                logger.info("finish parsing gcode")
+                end_time = time.time()
+                logger.info("spent time for gcode loading: %s s", end_time - start_time)
+            else:
+                loaded = self.model.set_gcode(filename, gc)
+            report(GCODE_PARSED_PERCENT)
+
+            if isinstance(loaded, gcode.LazyGCode):
+                return loaded, gui_utils.makeEmptyBlocks(len(loaded.layers))
+
+            # groups of layers are passed to the GUI thread as they are built
+            total = max(len(loaded.lays2rots), 1)
+
+            def percent(count):
+                return (
+                    GCODE_PARSED_PERCENT + (100 - GCODE_PARSED_PERCENT) * count / total
+                )
+
+            def built(count):
+                report(percent(count))
 
-            return gc
+            done = 0
+            for group in gui_utils.LayerGroups.build(loaded, level, built):
+                done += len(group.layers)
+                report(percent(done), group)
+            return loaded, None
 
-        gc = qt_utils.progress_dialog(
+        gc, blocks = qt_utils.progress_dialog(
             locales.getLocale().GCodeLoadingTitle,
             locales.getLocale().GCodeLoadingProgress,
             work,
+            on_progress=groups.append,
         )
-        blocks = gui_utils.makeBlocks(gc.layers, gc.rotations, gc.lays2rots)
-        actors = gui_utils.wrapWithActors(blocks, gc.rotations, gc.lays2rots)
+
+        lazy = isinstance(gc, gcode.LazyGCode)
+        group_tfs = None
+        if lazy:
+            group_tfs = gui_utils.GroupTransforms(gc.rotations, gc.rotations[0])
+            # layers parsed later widen the ranges, see build_layer
+            self.view.path_colors.fit(gc.head)
+            actors = gui_utils.wrapWithActors(
+                blocks, gc.rotations, gc.lays2rots, group_tfs, self.view.path_colors
+            )
+        else:
+            self.view.path_colors.fit(gc)
+            actors = gui_utils.LayerGroups(gc, groups, level, self.view.path_colors)
 
         if len(self.model.splanes) > 0:
             currentItem = int(self.view.splanes_tree.currentItem().text(1)) - 1
         else:
             currentItem = 0
 
-        self.view.load_gcode(actors, is_from_stl, plane_tf(gc.rotations[0]))
+        self.view.load_gcode(
+            actors,
+            is_from_stl,
+            plane_tf(gc.rotations[0]),
+            gc if lazy else None,
+            group_tfs,
+        )
 
         if len(self.model.splanes) > 0:
             self.view._recreate_splanes(self.model.splanes)
@@ -526,46 +572,116 @@ class MainController(FileManagementMixin):
 
         self.save_settings(slicing_type, PathBuilder.settings_file_temp())
 
-        def work():
-            start_time = time.time()
-            logger.info("start slicing")
-            p = Process(PathBuilder.slicing_cmd())
-            p.wait()
-            logger.info("finished command")
-            end_time = time.time()
-            logger.info("spent time for slicing: %s s", end_time - start_time)
-
-            if p.returncode == 2:
-                # panic
-                return p.stderr
-            elif p.returncode == 1:
-                # fatal, the error is in the latest line
-                error_message = p.stdout.splitlines()[-1]
-                if "path is not closed before triangulation" in error_message:
-                    return locales.getLocale().WarningPathNotClosed
-                else:
-                    return error_message
+        # the preview follows the output from scratch, the previous one must go
+        gcode_file = PathBuilder.gcodevis_file()
+        if os.path.exists(gcode_file):
+            os.remove(gcode_file)
+
+        logger.info("start slicing")
+        self.slicing_start_time = time.time()
+        self.slicing_process = Process(PathBuilder.slicing_cmd())
+        self.slicing_tail = gcode.GCodeTail(gcode_file)
+        rotations = self.slicing_tail.rotations
+        self.slicing_tfs = gui_utils.GroupTransforms(rotations, rotations[0])
+        self.view.start_gcode_preview()
+
+        # the output is read in a worker, the timer only starts the reads
+        self.slicing_manager = qt_utils.TaskManager(max_workers=1)
+        self.slicing_manager.finished.connect(self.show_slicing)
+        self.slicing_reading = False
+        self.slicing_timer = QtCore.QTimer()
+        self.slicing_timer.timeout.connect(self.poll_slicing)
+        self.slicing_timer.start(500)
+
+    def poll_slicing(self):
+        """Start reading the output of the slicer unless a read is running"""
+        if self.slicing_reading:
+            return
+        self.slicing_reading = True
+        self.slicing_manager.submit(
+            self.read_slicing, self.slicing_process, self.slicing_tail
+        )
 
-            # no errors
-            return ""
+    def read_slicing(self, p, tail):
+        # runs in the worker, parses a bounded part of the output and builds
+        # blocks of finished layers, the whole G-code once slicing is over,
+        # errors are returned, an exception would never reach show_slicing
+        try:
+            done = p.done  # checked before reading, so the last lines are not missed
+            layers = tail.poll()
+            blocks = None
+            if layers:
+                blocks = gui_utils.makeBlocks([layer for layer, _ in layers])
+            lays2rots = [rotation for _, rotation in layers]
+            rotations = list(tail.rotations)
+
+            finished = done and tail.caught_up
+            gc = None
+            if finished and not self.slicing_error(p):
+                gc = tail.finish()
+        except Exception as e:
+            return None, None, None, True, None, e
+        return blocks, rotations, lays2rots, finished, gc, None
+
+    def show_slicing(self, result):
+        """Show layers sliced so far and load the result once slicing is over"""
+        blocks, rotations, lays2rots, finished, gc, read_error = result
+        self.slicing_reading = False
+        if read_error is not None:
+            self.slicing_timer.stop()
+            logger.error("failed to read sliced gcode", exc_info=read_error)
+            self.view.cancel_gcode_preview()
+            gui_utils.showErrorDialog(str(read_error))
+            return
 
-        error = qt_utils.progress_dialog(
-            locales.getLocale().SlicingTitle,
-            locales.getLocale().SlicingProgress,
-            work,
-        )
+        if blocks is not None:
+            for block in blocks:
+                self.view.path_colors.fitBlock(block)
+            actors = gui_utils.wrapWithActors(
+                blocks, rotations, lays2rots, self.slicing_tfs, self.view.path_colors
+            )
+            self.view.add_gcode_layers(actors)
+
+        if not finished:
+            if not self.slicing_tail.caught_up:
+                self.poll_slicing()  # the output is ahead, keep reading
+            return
+
+        self.slicing_timer.stop()
+        logger.info("finished command")
+        end_time = time.time()
+        logger.info("spent time for slicing: %s s", end_time - self.slicing_start_time)
 
+        p = self.slicing_process
+        error = self.slicing_error(p)
         if error:
             logging.error(f"error: <{error}>")
+            self.view.cancel_gcode_preview()
             gui_utils.showErrorDialog(error)
             return
 
         # load gcode without calibration
+        self.view.finish_gcode_preview()
         self.view.picture_slider.setValue(0)
-        self.load_gcode(PathBuilder.gcodevis_file(), True)
+        self.load_gcode(PathBuilder.gcodevis_file(), True, gc)
         logger.info("loaded gcode")
         self.update_interface(sett().slicing.stl_filename)
 
+    def slicing_error(self, p):
+        if p.returncode == 2:
+            # panic
+            return p.stderr
+        elif p.returncode == 1:
+            # fatal, the error is in the latest line
+            error_message = p.stdout.splitlines()[-1]
+            if "path is not closed before triangulation" in error_message:
+                return locales.getLocale().WarningPathNotClosed
+            else:
+                return error_message
+
+        # no errors
+        return ""
+
     def check_calibration_data_catalog(self):
         if self.current_printer_is_default():
             locale = locales.getLocale()
@@ -38,6 +38,8 @@ def connect_signals(controller):
     view.setts.edit("printer_path").clicked.connect(controller.choose_printer_path)
     view.model_switch_box.stateChanged.connect(view.switch_stl_gcode)
     view.model_centering_box.stateChanged.connect(view.model_centering)
+    view.show_travels_box.stateChanged.connect(view.show_travels)
+    view.color_mode_box.currentIndexChanged.connect(view.change_color_mode)
     view.picture_slider.valueChanged.connect(controller.change_layer_view)
     view.move_button.clicked.connect(controller.move_model)
     view.place_button.clicked.connect(controller.place_model)
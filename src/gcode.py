@@ -1,9 +1,20 @@
+import bisect
+import hashlib
+import logging
 import math
-import numpy as np
+import mmap
+import multiprocessing
+import os
+import re
+from array import array
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from types import SimpleNamespace
 from typing import List, Optional
 
-from src import gui_utils
-import vtk
+import numpy as np
+
+logger = logging.getLogger(__name__)
 
 
 def rotation_matrix(axis, theta):
@@ -26,11 +37,255 @@ def rotation_matrix(axis, theta):
     )
 
 
+def rotation_matrices(axis, thetas):
+    """
+    Vectorized rotation_matrix: return (n, 3, 3) array of rotation matrices
+    about the same axis by every angle of thetas
+    """
+    axis = np.asarray(axis)
+    axis = axis / np.sqrt(np.dot(axis, axis))
+    thetas = np.asarray(thetas, dtype=np.float64)
+    a = np.cos(thetas / 2.0)
+    b, c, d = -axis[:, None] * np.sin(thetas / 2.0)
+    aa, bb, cc, dd = a * a, b * b, c * c, d * d
+    bc, ad, ac, ab, bd, cd = b * c, a * d, a * c, a * b, b * d, c * d
+    return np.stack(
+        [
+            np.stack([aa + bb - cc - dd, 2 * (bc + ad), 2 * (bd - ac)], axis=-1),
+            np.stack([2 * (bc - ad), aa + cc - bb - dd, 2 * (cd + ab)], axis=-1),
+            np.stack([2 * (bd + ac), 2 * (cd - ab), aa + dd - bb - cc], axis=-1),
+        ],
+        axis=-2,
+    )
+
+
 class GCode:
-    def __init__(self, layers, rotations, lays2rots):
-        self.layers: List[List[Point]] = layers
+    """
+    Parsed G-code stored in flat NumPy arrays
+
+    points - (N, 3) array with vertices of all paths one after another
+    path_offsets - (P + 1) array, path p is points[path_offsets[p]:path_offsets[p + 1]]
+    layer_offsets - (L + 1) array, layer l is paths layer_offsets[l]:layer_offsets[l + 1]
+    layer_rotations - (L) array, index of the rotation every layer was printed with
+    path_types - (P) uint8 array, PATH_EXTRUDE, PATH_TRAVEL or PATH_RETRACT code
+        of every path
+    path_stats - (P, 2) array, columns are views path_feed (the F value of the
+        path, mm/s, NaN before the first F) and path_flow (E per mm of the path)
+    layer_stats - (L, 4) array, columns are views layer_extrusion, layer_travel
+        (lengths of extruding and other moves, mm), layer_consumption (E, mm)
+        and layer_time (estimated, s). Moves of layers without paths are
+        counted in the next layer which has paths
+    """
+
+    def __init__(
+        self,
+        points,
+        path_offsets,
+        layer_offsets,
+        rotations,
+        lays2rots,
+        layer_stats=None,
+        path_types=None,
+        path_stats=None,
+    ):
+        self.points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+        self.path_offsets = np.asarray(path_offsets, dtype=np.int64)
+        self.layer_offsets = np.asarray(layer_offsets, dtype=np.int64)
         self.rotations: List[Rotation] = rotations
-        self.lays2rots = lays2rots
+        self.layer_rotations = np.asarray(lays2rots, dtype=np.int32)
+
+        if path_types is None:
+            path_types = np.full(len(self.path_offsets) - 1, PATH_EXTRUDE)
+        self.path_types = np.asarray(path_types, dtype=np.uint8)
+
+        if path_stats is None:
+            path_stats = np.full((len(self.path_types), PATH_STATS), np.nan)
+        self.path_stats = np.asarray(path_stats, dtype=np.float64).reshape(
+            -1, PATH_STATS
+        )
+        self.path_feed, self.path_flow = self.path_stats.T
+
+        if layer_stats is None:
+            layer_stats = np.zeros((len(self.layer_rotations), LAYER_STATS))
+        self.layer_stats = np.asarray(layer_stats, dtype=np.float64).reshape(
+            -1, LAYER_STATS
+        )
+        (
+            self.layer_extrusion,
+            self.layer_travel,
+            self.layer_consumption,
+            self.layer_time,
+        ) = self.layer_stats.T
+        # moves after the last layer, they belong to a layer parsed later
+        self.pending_stats = np.zeros(LAYER_STATS)
+
+        # list versions for the code which walks layers one by one
+        self.lays2rots: List[int] = self.layer_rotations.tolist()
+        self.layers = GCodeLayers(self)
+
+    def layer_points(self, idx):
+        """Return vertices of the layer and offsets of its paths starting from zero"""
+        first_path, last_path = self.layer_offsets[idx], self.layer_offsets[idx + 1]
+        offsets = self.path_offsets[first_path : last_path + 1]
+        return self.points[offsets[0] : offsets[-1]], offsets - offsets[0]
+
+    def layer_path_types(self, idx):
+        """Return types of paths of the layer"""
+        return self.path_types[self.layer_offsets[idx] : self.layer_offsets[idx + 1]]
+
+    def layer_path_stats(self, idx):
+        """Return (n, PATH_STATS) array with feed and flow of paths of the layer"""
+        return self.path_stats[self.layer_offsets[idx] : self.layer_offsets[idx + 1]]
+
+
+# types of paths: printed ones, moves without extrusion and moves made while
+# the filament is retracted
+PATH_EXTRUDE = 0
+PATH_TRAVEL = 1
+PATH_RETRACT = 2
+
+# feed and flow of a path
+PATH_STATS = 2
+# relative change of the flow which starts a new path
+FLOW_TOLERANCE = 0.1
+
+# extrusion length, travel length, consumption and time of a layer
+LAYER_STATS = 4
+
+
+class GCodeLayers(Sequence):
+    """Read-only view of GCode as nested lists of layers, paths and points"""
+
+    def __init__(self, gcode):
+        self.gcode = gcode
+
+    def __len__(self):
+        return len(self.gcode.lays2rots)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("layer index out of range")
+        gc = self.gcode
+        points, offsets = gc.layer_points(idx)
+        return GCodeLayer(
+            points,
+            offsets,
+            gc.layer_path_types(idx),
+            gc.layer_path_stats(idx),
+            gc.layer_time[idx],
+        )
+
+
+class GCodeLayer(Sequence):
+    """
+    Paths of a single layer, every path is returned as a list of Point,
+    path_types are their PATH_* codes and path_stats their feeds and flows,
+    time is the estimated time of the layer
+    """
+
+    def __init__(
+        self, points, path_offsets, path_types=None, path_stats=None, time=np.nan
+    ):
+        self.points = points
+        self.path_offsets = path_offsets
+        if path_types is None:
+            path_types = np.full(len(path_offsets) - 1, PATH_EXTRUDE, dtype=np.uint8)
+        self.path_types = path_types
+        if path_stats is None:
+            path_stats = np.full((len(path_types), PATH_STATS), np.nan)
+        self.path_stats = path_stats
+        self.time = time
+
+    def __len__(self):
+        return len(self.path_offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("path index out of range")
+        path = self.points[self.path_offsets[idx] : self.path_offsets[idx + 1]]
+        return [Point(x, y, z, 0, 0) for x, y, z in path.tolist()]
+
+
+class GCodeBuilder:
+    """Collects finished layers into growing flat arrays while G-code is parsed"""
+
+    def __init__(self):
+        self.points = np.empty((1024, 3), dtype=np.float64)
+        self.points_count = 0
+        self.path_offsets = array("q", [0])
+        self.layer_offsets = array("q", [0])
+        self.lays2rots = array("i")
+        self.path_types = array("B")
+        self.path_stats = array("d")
+        self.layer_stats = array("d")
+        self.pending_stats = np.zeros(LAYER_STATS)  # go to the next added layer
+
+    def addLayer(self, paths, rotation, stats=None, types=None, path_stats=None):
+        for path in paths:
+            self.addPoints(path)
+            self.path_offsets.append(self.points_count)
+        if types is None:
+            types = [PATH_EXTRUDE] * len(paths)
+        self.path_types.extend(types)
+        if path_stats is None:
+            path_stats = [(np.nan,) * PATH_STATS] * len(paths)
+        for values in path_stats:
+            self.path_stats.extend(values)
+        self.layer_offsets.append(len(self.path_offsets) - 1)
+        self.lays2rots.append(rotation)
+
+        if stats is not None:
+            self.pending_stats += stats
+        self.layer_stats.extend(self.pending_stats)
+        self.pending_stats[:] = 0
+
+    def addPoints(self, points):
+        end = self.points_count + len(points)
+        if end > len(self.points):
+            # grow geometrically to keep appends amortized O(1)
+            self.points.resize((max(end, 2 * len(self.points)), 3), refcheck=False)
+        self.points[self.points_count : end] = points
+        self.points_count = end
+
+    def addGCode(self, gc):
+        """Append every layer of already built G-code, e.g. a parsed chunk of a file"""
+        path_shift = len(self.path_offsets) - 1
+        self.path_offsets.frombytes((gc.path_offsets[1:] + self.points_count).tobytes())
+        self.addPoints(gc.points)
+        self.layer_offsets.frombytes((gc.layer_offsets[1:] + path_shift).tobytes())
+        self.lays2rots.frombytes(gc.layer_rotations.tobytes())
+        self.path_types.frombytes(gc.path_types.tobytes())
+        self.path_stats.frombytes(gc.path_stats.tobytes())
+
+        stats = gc.layer_stats.copy()
+        if len(stats):
+            stats[0] += self.pending_stats
+            self.pending_stats[:] = 0
+        self.layer_stats.frombytes(stats.tobytes())
+        self.pending_stats += gc.pending_stats
+
+    def build(self, rotations):
+        self.points.resize((self.points_count, 3), refcheck=False)
+        gc = GCode(
+            self.points,
+            np.frombuffer(self.path_offsets, dtype=np.int64),
+            np.frombuffer(self.layer_offsets, dtype=np.int64),
+            rotations,
+            np.frombuffer(self.lays2rots, dtype=np.int32),
+            np.frombuffer(self.layer_stats, dtype=np.float64),
+            np.frombuffer(self.path_types, dtype=np.uint8),
+            np.frombuffer(self.path_stats, dtype=np.float64),
+        )
+        gc.pending_stats = self.pending_stats.copy()
+        return gc
 
 
 class Rotation:
@@ -51,12 +306,8 @@ class Point:
         self.b = b
 
     def xyz(self, rot):
-        cur = [self.x, self.y, self.z]
-        if self.a == 0:
-            return cur
-        tf = gui_utils.prepareTransform(Rotation(self.a, self.b), rot)
-        res = tf.TransformPoint(cur)
-        return res
+        # parsed points are already in coordinates of the bed
+        return [self.x, self.y, self.z]
 
 
 class Position:
@@ -78,10 +329,59 @@ class Position:
         return Position(self.X, self.Y, self.Z, self.U, self.V, self.E)
 
 
+class MotionLimits:
+    """
+    Speed and jerk (mm/s or deg/s) and acceleration (mm/s^2 or deg/s^2) of
+    every axis taken from hardware settings, where speeds are per minute
+    """
+
+    def __init__(self, hardware):
+        self.speed = {k: v / 60 for k, v in _axesValues(hardware.max_speed).items()}
+        self.acceleration = _axesValues(hardware.acceleration)
+        self.jerk = {k: v / 60 for k, v in _axesValues(hardware.max_jerk).items()}
+        self.profiles = {}
+
+    def profile(self, axis, feed):
+        """
+        (speed, acceleration, jerk, ramp, ramp time) of moves along the axis
+        which start and stop at the jerk speed and accelerate up to the feed
+        rate, ramp is the distance of acceleration and deceleration together
+        """
+        res = self.profiles.get((axis, feed))
+        if res is None:
+            speed = self.speed[axis]
+            if feed is not None and feed < speed:
+                speed = feed
+            acceleration = self.acceleration[axis]
+            jerk = min(self.jerk[axis], speed)
+            ramp = (speed * speed - jerk * jerk) / acceleration
+            res = (speed, acceleration, jerk, ramp, 2 * (speed - jerk) / acceleration)
+            self.profiles[axis, feed] = res
+        return res
+
+    def moveTime(self, axis, distance, feed):
+        """Time of a move along the axis, see profile"""
+        return _profileTime(self.profile(axis, feed), distance)
+
+
+def _profileTime(profile, distance):
+    speed, acceleration, jerk, ramp, ramp_time = profile
+    if ramp < distance:
+        return ramp_time + (distance - ramp) / speed
+    # triangular profile, the feed rate is never reached
+    return 2 * (math.sqrt(jerk * jerk + acceleration * distance) - jerk) / acceleration
+
+
+def _axesValues(values):
+    return {key: float(getattr(values, key)) for key in "XYZUVE"}
+
+
 class Printer:
     def __init__(self, s):
         self.currPos = Position(0, 0, 0, 0, 0, 0)
         self.prevPos = Position(0, 0, 0, 0, 0, 0)
+        self.limits = MotionLimits(s.hardware)
+        self.setFeed(None)
 
         self.rotationPoint = np.array(
             [
@@ -92,17 +392,55 @@ class Printer:
         )
         self.cone_axis = rotation_matrix([1, 0, 0], 0).dot([0, 0, 1])
 
-        self.path = []
-        self.layer = []
+        self.path = []  # (X, Y, Z, U) of every vertex of the current run of paths
+        self.path_type = PATH_EXTRUDE
+        self.path_feed = None
+        # (last vertex, feed, length, extrusion) of paths split off the run
+        self.path_splits = []
+        self.path_length = 0.0  # mm of the current path
+        self.path_extrusion = 0.0  # E of the current path
+        self.layer = []  # (n, 3) arrays of finished paths of the current layer
+        self.layer_types = []  # types of paths of the current layer
+        self.layer_path_stats = []  # (feed, flow) of paths of the current layer
+        self.layer_extrusions = 0  # printed paths of the current layer
+        self.retracted = False
         self.layers = []
         self.rotations = []
         self.rotations.append(Rotation(0, 0))
         self.lays2rots = []
+        self.layers_types = []
+        self.layers_path_stats = []
+        self.layers_stats = []
+        # LAYER_STATS of moves since the last finished layer
+        self.stats = [0.0] * LAYER_STATS
         self.abs_pos = True  # absolute positioning
 
-        # add an empty layer in the beginning
-        self.layers.append(self.layer)
-        self.lays2rots.append(len(self.rotations) - 1)
+        # the first layer is always emitted, even if it stays empty
+        self.first_layer = True
+        self.current_layer = 0
+        self.tool = 0  # select extruder (0) or incline (2) or rotate (1)
+
+    def getState(self):
+        # everything which is carried from one layer to the next one
+        pos = self.currPos
+        return (
+            (pos.X, pos.Y, pos.Z, pos.U, pos.V, pos.E),
+            self.abs_pos,
+            len(self.rotations),
+            self.cone_axis,
+            self.feed,
+            self.retracted,
+        )
+
+    def setState(self, state, rotations):
+        pos, self.abs_pos, rotations_count, self.cone_axis, feed, retracted = state
+        self.retracted = retracted
+        self.setFeed(feed)
+        self.currPos = Position(*pos)
+        self.prevPos = Position(*pos)
+        self.rotations = list(rotations[:rotations_count])
+        # state is taken at layer starts, so the first layer is already behind
+        self.first_layer = False
 
     def parseArgs(self, args):
         # convert text args to values
@@ -111,7 +449,7 @@ class Printer:
             if len(arg) == 0:
                 continue
             key, val = arg[0], arg[1:]
-            if key in "XYZUVE":
+            if key in "XYZUVEF":
                 res[key] = float(val)
             elif key == ";":
                 break
@@ -119,108 +457,325 @@ class Printer:
         return res
 
     def setAbsPos(self, args):
-        res = self.parseArgs(args)
+        self.setAbsValues(self.parseArgs(args))
 
-        for key, val in res.items():
+    def setAbsValues(self, values):
+        for key, val in values.items():
             setattr(self.currPos, key, val)
 
     def setRelPos(self, args):
-        res = self.parseArgs(args)
+        self.setRelValues(self.parseArgs(args))
 
-        for key, val in res.items():
+    def setRelValues(self, values):
+        for key, val in values.items():
             val += getattr(self.currPos, key)
             setattr(self.currPos, key, val)
 
     def updatePos(self, args):
+        self.moveTo(self.parseArgs(args))
+
+    def setFeed(self, feed):
+        self.feed = feed  # mm/s, the last F value
+        # most moves are horizontal, their profile is looked up once
+        self.xy_profile = self.limits.profile("X", feed)
+
+    def moveTo(self, values):
+        if "F" in values:
+            feed = values.pop("F") / 60
+            if feed != self.feed:
+                self.setFeed(feed)
+
+        prev, curr = self.prevPos, self.currPos
+
         # update previous position
-        self.prevPos.apply(self.currPos)
+        prev.X, prev.Y, prev.Z = curr.X, curr.Y, curr.Z
+        prev.U, prev.V, prev.E = curr.U, curr.V, curr.E
 
         # apply values to the printer position
         if self.abs_pos:
-            self.setAbsPos(args)
+            self.setAbsValues(values)
+        else:
+            self.setRelValues(values)
+
+        self.dX = dX = prev.X - curr.X
+        self.dY = dY = prev.Y - curr.Y
+        self.dZ = dZ = prev.Z - curr.Z
+        self.dU = prev.U - curr.U
+        self.dE = dE = prev.E - curr.E
+        noMove = dX == 0 and dY == 0 and dZ == 0 and self.dU == 0
+
+        # add the move to statistics of the current layer
+        length = math.hypot(dX, dY, dZ)
+        if length > 0:
+            stats = self.stats
+            stats[0 if dE < 0 else 1] += length
+            stats[2] -= dE
+            if dX != 0 or dY != 0:
+                speed, _, _, ramp, ramp_time = self.xy_profile
+                if ramp < length:
+                    stats[3] += ramp_time + (length - ramp) / speed
+                else:
+                    stats[3] += _profileTime(self.xy_profile, length)
+            else:
+                stats[3] += self.limits.moveTime("Z", length, self.feed)
         else:
-            self.setRelPos(args)
+            self.countStill(prev.V - curr.V)
 
-        self.dX = self.prevPos.X - self.currPos.X
-        self.dY = self.prevPos.Y - self.currPos.Y
-        self.dZ = self.prevPos.Z - self.currPos.Z
-        self.dU = self.prevPos.U - self.currPos.U
-        self.dE = self.prevPos.E - self.currPos.E
-        noMove = self.dX == 0 and self.dY == 0 and self.dZ == 0 and self.dU == 0
+        if dE != 0:
+            # E decreases while retracting
+            self.retracted = dE > 0
+
+        if noMove:
+            self.finishPath()
+            return
 
-        if self.dE == 0 or noMove:
+        if dE < 0:
+            path_type = PATH_EXTRUDE
+        elif self.retracted:
+            path_type = PATH_RETRACT
+        else:
+            path_type = PATH_TRAVEL
+        if path_type != self.path_type:
             self.finishPath()
+            self.path_type = path_type
+            self.path_feed = self.feed
+        elif self.feed != self.path_feed:
+            self.splitPath()
+            self.path_feed = self.feed
+        elif dE < 0 and length > 0 and self.path_length > 0:
+            # paths keep nearly the same flow, so it may be shown per path,
+            # flows of the move and of the path are compared without divisions
+            extrusion = self.path_extrusion * length
+            if abs(extrusion + dE * self.path_length) > FLOW_TOLERANCE * extrusion:
+                self.splitPath()
+        self.path_length += length
+        self.path_extrusion -= dE
+
+        path = self.path
+        if not path:
+            path.append((prev.X, prev.Y, prev.Z, prev.U))
+        path.append((curr.X, curr.Y, curr.Z, curr.U))
+
+    def countStill(self, dV):
+        # statistics of moves which keep the nozzle in place: rotations or retractions
+        if self.dU != 0:
+            axis, distance = "U", abs(self.dU)
+        elif dV != 0:
+            axis, distance = "V", abs(dV)
+        elif self.dE != 0:
+            axis, distance = "E", abs(self.dE)
         else:
-            if len(self.path) == 0:
-                self.path.append(self.prevPos.getCopy())
-            self.path.append(self.currPos.getCopy())
+            return
+
+        self.stats[2] -= self.dE
+        self.stats[3] += self.limits.moveTime(axis, distance, self.feed)
 
-    def pathSplit(self):
+    def pathSplit(self, path):
+        """
+        Insert intermediate vertices so that U changes by at most maxDeltaU,
+        returns the new path and indices of the original vertices in it
+        """
         maxDeltaU = 5
 
-        lastPos = self.path[0]
-        res = [(lastPos.X, lastPos.Y, lastPos.Z, lastPos.U)]
-        for pos in self.path[1:]:
-            numPoints = int(abs(lastPos.U - pos.U) // maxDeltaU)
-            if numPoints > 0:
-                rangeU = list(np.linspace(lastPos.U, pos.U, numPoints + 2)[1:])
-                rangeX = list(np.linspace(lastPos.X, pos.X, numPoints + 2)[1:])
-                rangeY = list(np.linspace(lastPos.Y, pos.Y, numPoints + 2)[1:])
-                rangeZ = list(np.linspace(lastPos.Z, pos.Z, numPoints + 2)[1:])
-
-                for dU, dX, dY, dZ in zip(rangeU, rangeX, rangeY, rangeZ):
-                    res.append((dX, dY, dZ, dU))
-            else:
-                res.append((pos.X, pos.Y, pos.Z, pos.U))
-            lastPos = pos
+        # every segment gets numPoints + 1 new vertices evenly spread up to its end
+        counts = (np.abs(np.diff(path[:, 3])) // maxDeltaU).astype(np.int64) + 1
+        segments = np.repeat(np.arange(len(path) - 1), counts)
+        starts = np.repeat(np.cumsum(counts) - counts, counts)
+        t = ((np.arange(len(segments)) - starts + 1) / counts[segments])[:, None]
 
-        return res
+        res = path[segments] * (1 - t) + path[segments + 1] * t
+        vertices = np.concatenate([[0], np.cumsum(counts)])
+        return np.concatenate([path[:1], res]), vertices
+
+    def splitPath(self):
+        # end a path at the last vertex when the feed or the flow changes, the
+        # run goes on, so its geometry is converted as a whole
+        if len(self.path) >= 2:
+            self.path_splits.append(
+                (
+                    len(self.path) - 1,
+                    self.path_feed,
+                    self.path_length,
+                    self.path_extrusion,
+                )
+            )
+            self.path_length = self.path_extrusion = 0.0
 
     def finishPath(self):
-        # finish path and start new
+        # finish the run of paths and start new
         if len(self.path) < 2:
             return
 
-        # U coordinate of cone path differs from current bed plane Z rotation
-        pathIsCone = False
-        for pos in self.path:
-            if pos.U != self.rotations[-1].z_rot:
-                pathIsCone = True
-                break
+        path = np.array(self.path, dtype=np.float64)
+        splits = self.path_splits
+        splits.append(
+            (len(path) - 1, self.path_feed, self.path_length, self.path_extrusion)
+        )
+        self.path_length = self.path_extrusion = 0.0
 
-        points = []
-        if pathIsCone:
-            rotationPoint = self.rotationPoint
-            cone_axis = self.cone_axis
-
-            for xr, yr, zr, ur in self.pathSplit():
-                # convert from cylindrical coordinates to xyz
-                u = math.radians(ur)
-                r = yr
-                z = zr
-
-                xr, yr, zr = (
-                    rotation_matrix(cone_axis, -u).dot(
-                        np.array([xr, r, z]) - rotationPoint
-                    )
-                    + rotationPoint
-                )
+        # U coordinate of cone path differs from current bed plane Z rotation,
+        # this is decided for the whole run as paths of cones may start flat
+        pathIsCone = np.any(path[:, 3] != self.rotations[-1].z_rot)
 
-                points.append(Point(xr, yr, zr, 0, 0))
+        if pathIsCone:
+            # convert from cylindrical coordinates to xyz
+            path, vertices = self.pathSplit(path)
+            rotations = rotation_matrices(self.cone_axis, -np.radians(path[:, 3]))
+            points = (
+                np.einsum("nij,nj->ni", rotations, path[:, :3] - self.rotationPoint)
+                + self.rotationPoint
+            )
         else:
-            for pos in self.path:
-                points.append(Point(pos.X, pos.Y, pos.Z, 0, 0))
+            points = np.ascontiguousarray(path[:, :3])
+            vertices = None
 
-        self.layer.append(points)
+        start = 0
+        for end, feed, length, extrusion in splits:
+            if vertices is not None:
+                end = vertices[end]
+            self.layer.append(points[start : end + 1])
+            self.layer_types.append(self.path_type)
+            feed = np.nan if feed is None else feed
+            self.layer_path_stats.append((feed, extrusion / length if length else 0.0))
+            start = end
+        if self.path_type == PATH_EXTRUDE:
+            self.layer_extrusions += len(splits)
         self.path = []
+        self.path_splits = []
 
     def finishLayer(self):
         self.finishPath()
-        if len(self.layer) > 0:
+        if self.first_layer:
+            self.layers.append(self.layer)
+            self.lays2rots.append(len(self.rotations) - 1)
+            self.layers_types.append(self.layer_types)
+            self.layers_path_stats.append(self.layer_path_stats)
+            self.layers_stats.append(self.popStats())
+            self.first_layer = False
+        # moves of layers without printed paths are not shown
+        if self.layer_extrusions > 0:
             self.layers.append(self.layer)
             self.lays2rots.append(len(self.rotations) - 1)
+            self.layers_types.append(self.layer_types)
+            self.layers_path_stats.append(self.layer_path_stats)
+            self.layers_stats.append(self.popStats())
 
         self.layer = []
+        self.layer_types = []
+        self.layer_path_stats = []
+        self.layer_extrusions = 0
+
+    def popStats(self):
+        # statistics of moves which are not yet given to any layer
+        res = self.stats
+        self.stats = [0.0] * LAYER_STATS
+        return res
+
+    def popLayers(self):
+        # hand over printed paths of finished layers with their rotation indices
+        return [
+            (
+                [path for path, kind in zip(paths, types) if kind == PATH_EXTRUDE],
+                rotation,
+            )
+            for paths, rotation, _, types, _ in self.popLayersData()
+        ]
+
+    def popLayersData(self):
+        # like popLayers, every layer goes with all its paths, statistics,
+        # path types and path statistics
+        res = list(
+            zip(
+                self.layers,
+                self.lays2rots,
+                self.layers_stats,
+                self.layers_types,
+                self.layers_path_stats,
+            )
+        )
+        self.layers = []
+        self.lays2rots = []
+        self.layers_stats = []
+        self.layers_types = []
+        self.layers_path_stats = []
+        return res
+
+
+_ROTATION_MARKERS = ("rotation-hack", "rotation", "incline-hack", "incline")
+
+
+class PositionScanner(Printer):
+    """Printer which only follows the position and does not build any paths"""
+
+    def moveTo(self, values):
+        if "F" in values:
+            self.setFeed(values.pop("F") / 60)
+
+        e = self.currPos.E
+        if self.abs_pos:
+            self.setAbsValues(values)
+        else:
+            self.setRelValues(values)
+        if self.currPos.E != e:
+            self.retracted = self.currPos.E < e
+
+    def finishPath(self):
+        pass
+
+    def finishLayer(self):
+        pass
+
+
+class ExtrusionScanner(PositionScanner):
+    """
+    PositionScanner which notes the first move that prints, such a move makes
+    Printer emit the layer it belongs to
+    """
+
+    printed = False
+
+    def moveTo(self, values):
+        prev = self.currPos.getCopy()
+        super().moveTo(values)
+        curr = self.currPos
+        if curr.E > prev.E and (
+            curr.X != prev.X or curr.Y != prev.Y or curr.Z != prev.Z or curr.U != prev.U
+        ):
+            self.printed = True
+
+
+class MoveRecorder(PositionScanner):
+    """
+    Printer which records every move as changes of X, Y, Z, U, V, E and the feed
+
+    Rotations and inclines set by markers are recorded as separate moves,
+    G92 moves the origin without any motion
+    """
+
+    def __init__(self, s):
+        super().__init__(s)
+        self.moves = array("d")
+        self.last = self.position()  # position after the last recorded move
+
+    def position(self):
+        pos = self.currPos
+        return pos.X, pos.Y, pos.Z, pos.U, pos.V, pos.E
+
+    def record(self):
+        pos = self.position()
+        if pos != self.last:
+            self.moves.extend([p - last for p, last in zip(pos, self.last)])
+            self.moves.append(math.nan if self.feed is None else self.feed)
+            self.last = pos
+
+    def moveTo(self, values):
+        self.record()  # a marker may have rotated the bed since the last move
+        super().moveTo(values)
+        self.record()
+
+    def finishPath(self):
+        # only G92 calls it here, the position is set without moving
+        self.last = self.position()
 
 
 def parseRotation(args: List[str]):
@@ -235,113 +790,835 @@ def parseRotation(args: List[str]):
     return e
 
 
-def readGCode(filename):
-    with open(filename, "r", encoding="utf-8") as f:
-        lines = [line.strip() for line in f]
-    return parseGCode(lines)
+# bytes read between two progress reports of a parser
+REPORT_SIZE = 1 << 20
+
 
+def readMappedLines(filename, start=0, end=None, report=None):
+    """
+    Yield undecoded lines of the file between byte offsets start and end
 
-def parseGCode(lines, settings=None):
-    layer = []
-    planes = []
+    The file is memory mapped, so it is neither copied into read buffers nor
+    decoded, and reloads of the same file are served from the page cache.
+    With report it is called with the offset reached every REPORT_SIZE bytes
+    """
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if end is None:
+                end = len(mm)
+            mm.seek(start)
+            readline = mm.readline
+            pos = start
+            next_report = math.inf if report is None else start + REPORT_SIZE
+            while pos < end:
+                line = readline()
+                pos += len(line)
+                if pos >= next_report:
+                    report(pos)
+                    next_report = pos + REPORT_SIZE
+                yield line
 
+
+def readGCode(filename, settings=None, report=None):
+    """
+    Parse the whole file at once, report is called with the byte offset
+    parsed so far, see readMappedLines
+    """
+    lines = readMappedLines(filename, report=report)
+    return parseGCode(lines, settings, parseMappedLine)
+
+
+def readMoves(filename, settings=None):
+    """
+    Return (M, 6) array with changes of X, Y, Z, U, V, E made by every move
+    of the file and (M) array of their feed rates in mm/s, nan before any F
+    """
     if settings is None:
-        from src import settings as settings_module
+        settings = _default_settings()
+
+    recorder = MoveRecorder(settings)
+    for line in readMappedLines(filename):
+        if not parseMappedLine(recorder, line, settings):
+            break
+    recorder.record()
+
+    moves = np.frombuffer(recorder.moves, dtype=np.float64).reshape(-1, 7)
+    return moves[:, :6], moves[:, 6]
+
+
+CACHE_VERSION = 4
 
-        settings = settings_module.sett()
+_SLICING_INFO = ("print_time", "consumption_material", "planes_contact_with_nozzle")
 
-    s = settings
 
-    current_layer = 0
+def cachePath(filename):
+    """Binary sidecar with the parsed geometry, stored next to the G-code file"""
+    return str(filename) + ".npz"
+
+
+def cacheKey(filename, settings):
+    """
+    Identify the parsed geometry by the file size, mtime and content hash,
+    by the rotation center the cone paths were converted with and by motion
+    limits the print time was estimated with
+    """
+    stat = os.stat(filename)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+
+    hw = settings.hardware
+    limits = [
+        sorted(_axesValues(values).items())
+        for values in (hw.max_speed, hw.acceleration, hw.max_jerk)
+    ]
+    return "%d:%d:%d:%s:%r:%r:%r:%r" % (
+        CACHE_VERSION,
+        stat.st_size,
+        stat.st_mtime_ns,
+        digest.hexdigest(),
+        float(hw.rotation_center_x),
+        float(hw.rotation_center_y),
+        float(hw.rotation_center_z),
+        limits,
+    )
+
+
+def saveCache(gc, filename, key, settings):
+    slicing = settings.slicing
+    info = [str(getattr(slicing, name, "")) for name in _SLICING_INFO]
+
+    path = cachePath(filename)
+    tmp_path = path + ".tmp.npz"
+    np.savez(
+        tmp_path,
+        key=np.array(key),
+        points=gc.points,
+        path_offsets=gc.path_offsets,
+        layer_offsets=gc.layer_offsets,
+        layer_rotations=gc.layer_rotations,
+        layer_stats=gc.layer_stats,
+        path_types=gc.path_types,
+        path_stats=gc.path_stats,
+        rotations=np.array([(r.x_rot, r.z_rot) for r in gc.rotations]),
+        slicing_info=np.array(info),
+    )
+    os.replace(tmp_path, path)
 
-    t = 0  # select extruder (t==0) or incline (t==2) or rotate (t==1)
+
+def loadCache(filename, key, settings):
+    """Return cached GCode if the sidecar matches the key, otherwise None"""
+    try:
+        with np.load(cachePath(filename), allow_pickle=False) as data:
+            if str(data["key"]) != key:
+                return None
+            gc = GCode(
+                data["points"],
+                data["path_offsets"],
+                data["layer_offsets"],
+                [Rotation(x, z) for x, z in data["rotations"].tolist()],
+                data["layer_rotations"],
+                data["layer_stats"],
+                data["path_types"],
+                data["path_stats"],
+            )
+            print_time, consumption_material, planes = data["slicing_info"].tolist()
+    except (OSError, KeyError, ValueError):
+        return None
+
+    # these values come from comments, restore them as the parser would do
+    settings.slicing.print_time = float(print_time)
+    settings.slicing.consumption_material = float(consumption_material)
+    settings.slicing.planes_contact_with_nozzle = planes
+    return gc
+
+
+def readGCodeCached(filename, settings=None, reader=None, report=None):
+    """
+    Load parsed G-code from the binary sidecar, parse the file and store
+    the sidecar when it is missing or outdated, report is passed to the reader
+
+    Lazily parsed layers are never held all at once, so they are not stored.
+    The file is hashed only to check an existing sidecar or to store a new one
+    """
+    if settings is None:
+        settings = _default_settings()
+    if reader is None:
+        reader = readGCodeParallel
+
+    key = None
+    path = cachePath(filename)
+    if os.path.exists(path):
+        key = cacheKey(filename, settings)
+        gc = loadCache(filename, key, settings)
+        if gc is not None:
+            return gc
+
+    gc = reader(filename, settings=settings, report=report)
+    if isinstance(gc, GCode):
+        storeCache(gc, filename, settings, key)
+    elif key is not None:
+        # the outdated sidecar would only make every next load hash the file
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning("failed to remove outdated gcode cache: %s", e)
+    return gc
+
+
+def storeCache(gc, filename, settings=None, key=None):
+    """Store the sidecar for G-code parsed elsewhere, failures are only logged"""
+    if settings is None:
+        settings = _default_settings()
+
+    try:
+        if key is None:
+            key = cacheKey(filename, settings)
+        saveCache(gc, filename, key, settings)
+    except OSError as e:
+        logger.warning("failed to store parsed gcode cache: %s", e)
+
+
+def scanLayers(filename, settings=None):
+    """
+    Fast pass over the file which finds byte offsets of lines where layers
+    end, ";LAYER:" lines and rotation or incline markers, and the printer
+    state right before each of them
+
+    Returns a list of (offset, state) pairs, the offset where parsing stops
+    and the full list of rotations
+    """
+    if settings is None:
+        settings = _default_settings()
+
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return [], 0, [Rotation(0, 0)]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _scanMapped(mm, filename, settings)
+
+
+def _lineBounds(mm, pos):
+    start = mm.rfind(b"\n", 0, pos) + 1
+    end = mm.find(b"\n", pos)
+    return start, len(mm) if end == -1 else end
+
+
+def _findLines(mm, marker, end):
+    # offsets of lines which start with the marker (leading spaces are ignored)
+    res = []
+    pos = mm.find(marker, 0, end)
+    while pos != -1:
+        start, _ = _lineBounds(mm, pos)
+        if not mm[start:pos].strip():
+            res.append(start)
+        pos = mm.find(marker, pos + 1, end)
+    return res
+
+
+def _isMarker(line):
+    # mirrors parseLine, the comment separator is required
+    return ";" in line and line.endswith(_ROTATION_MARKERS)
+
+
+def _scanMapped(mm, filename, s):
+    end = len(mm)
+    end_lines = _findLines(mm, b";End", end)
+    if end_lines:
+        end = end_lines[0]
+
+    if _findLines(mm, b"G91", end):
+        # relative moves depend on the whole history, follow it line by line
+        return _scanSequential(filename, s)
+
+    def line_at(pos):
+        start, stop = _lineBounds(mm, pos)
+        return start, mm[start:stop].decode("utf-8").strip()
+
+    scanner = PositionScanner(s)
+
+    for marker in (
+        b";Estimated print time:",
+        b";Estimated consumption material:",
+        b";Planes contact with nozzle:",
+    ):
+        for start in _findLines(mm, marker, end):
+            parseLine(scanner, line_at(start)[1], s)
+
+    # rotation and incline markers are rare, replay them to collect all rotations
+    markers = {}
+    for word in (b"rotation", b"incline"):
+        pos = mm.find(word, 0, end)
+        while pos != -1:
+            start, line = line_at(pos)
+            if _isMarker(line):
+                markers[start] = line
+            pos = mm.find(word, pos + 1, end)
+
+    marker_starts = sorted(markers)
+    u_markers, v_markers = [], []
+    for start in marker_starts:
+        parseLine(scanner, markers[start], s)
+        if "rotation" in markers[start]:
+            u_markers.append((start, scanner.currPos.U))
+        else:
+            v_markers.append((start, scanner.currPos.V))
+
+    def last_setter(key, lo, hi, commands=("G0", "G1", "G92")):
+        # the last of commands in [lo, hi) which sets the key, as (offset, value)
+        token = b" " + key.encode()
+        pos = mm.rfind(token, lo, hi)
+        while pos != -1:
+            start, line = line_at(pos)
+            if not _isMarker(line):
+                args = line.split(";")[0].split(" ")
+                if args[0] in commands:
+                    val = scanner.parseArgs(args[1:]).get(key)
+                    if val is not None:
+                        return start, val
+            pos = mm.rfind(token, lo, start)
+        return None
+
+    def last_marker(values, pos):
+        idx = bisect.bisect_left(values, (pos,)) - 1
+        return values[idx] if idx >= 0 else None
+
+    def retracted_at(hi):
+        # the filament is retracted if the last move which changed E decreased it
+        move = last_setter("E", 0, hi, ("G0", "G1"))
+        while move is not None:
+            before = last_setter("E", 0, move[0])
+            e = 0 if before is None else before[1]
+            if move[1] != e:
+                return move[1] < e
+            move = last_setter("E", 0, move[0], ("G0", "G1"))
+        return False
+
+    pos = dict(X=0, Y=0, Z=0, U=0, V=0, E=0, F=None)
+    setters = {}
+    marks = []
+    prev = 0
+    for offset in sorted(set(_findLines(mm, b";LAYER:", end) + marker_starts)):
+        for key in "XYZUVEF":
+            found = last_setter(key, prev, offset)
+            if found is not None:
+                setters[key] = found
+
+            # markers set U and V bypassing G0 arguments
+            marker = last_marker(u_markers if key == "U" else v_markers, offset)
+            if key in "UV" and marker is not None:
+                if key not in setters or setters[key][0] < marker[0]:
+                    setters[key] = marker
+
+            if key in setters:
+                pos[key] = setters[key][1]
+        prev = offset
+
+        rotations_count = bisect.bisect_left(marker_starts, offset) + 1
+        x_rot = scanner.rotations[rotations_count - 1].x_rot
+        state = (
+            tuple(pos[key] for key in "XYZUVE"),
+            True,
+            rotations_count,
+            rotation_matrix([1, 0, 0], np.radians(x_rot)).dot([0, 0, 1]),
+            None if pos["F"] is None else pos["F"] / 60,
+            retracted_at(offset),
+        )
+        marks.append((offset, state))
+
+    return marks, end, scanner.rotations
+
+
+def _scanSequential(filename, settings):
+    scanner = PositionScanner(settings)
+    marks = []
+    offset = 0
+    with open(filename, "rb") as f:
+        for raw in f:
+            line = raw.decode("utf-8").strip()
+            if line.startswith(";LAYER:") or _isMarker(line):
+                marks.append((offset, scanner.getState()))
+            if not parseLine(scanner, line, settings):
+                break
+            offset += len(raw)
+
+    return marks, offset, scanner.rotations
+
+
+def readGCodeParallel(
+    filename,
+    processes=None,
+    settings=None,
+    min_chunk_size=1 << 24,
+    scan=None,
+    report=None,
+):
+    """
+    Parse G-code in a pool of processes
+
+    The file is pre-scanned for layer ends and the state carried across them,
+    then chunks of at least min_chunk_size bytes are parsed independently and merged.
+    A result of scanLayers may be passed as scan to skip the pre-scan, report
+    is called with the byte offset parsed so far
+    """
+    if settings is None:
+        settings = _default_settings()
+    processes = processes or os.cpu_count() or 1
+
+    if scan is None:
+        scan = scanLayers(filename, settings)
+    marks, end, rotations = scan
+
+    # the first chunk always includes the first layer mark with the leading layer
+    chunk_size = max(min_chunk_size, end // (processes * 4) + 1)
+    chunks = [(0, None)]
+    for offset, state in marks[1:]:
+        if offset - chunks[-1][0] >= chunk_size:
+            chunks.append((offset, state))
+
+    if processes == 1 or len(chunks) == 1:
+        return readGCode(filename, settings, report)
+
+    hardware = _workerHardware(settings)
+    starts = [offset for offset, _ in chunks]
+    ends = starts[1:] + [end]
+    states = [state for _, state in chunks]
+
+    builder = GCodeBuilder()
+    # the app runs other threads, forking it might copy their held locks
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        parsed = executor.map(
+            _parseChunk,
+            [filename] * len(chunks),
+            starts,
+            ends,
+            states,
+            [rotations] * len(chunks),
+            [hardware] * len(chunks),
+        )
+        for chunk_end, gc in zip(ends, parsed):
+            builder.addGCode(gc)
+            if report is not None:
+                report(chunk_end)
+
+    builder.addLayer([], len(rotations) - 1)  # add dummy layer for back rotations
+    return builder.build(rotations)
+
+
+def _workerHardware(settings):
+    # the part of settings which chunk parsers need, it is cheap to pickle
+    hw = settings.hardware
+    return SimpleNamespace(
+        rotation_center_x=hw.rotation_center_x,
+        rotation_center_y=hw.rotation_center_y,
+        rotation_center_z=hw.rotation_center_z,
+        max_speed=SimpleNamespace(**_axesValues(hw.max_speed)),
+        acceleration=SimpleNamespace(**_axesValues(hw.acceleration)),
+        max_jerk=SimpleNamespace(**_axesValues(hw.max_jerk)),
+    )
+
+
+def _parseChunk(filename, start, end, state, rotations, hardware):
+    # runs in a worker process, settings are reduced to what the parser needs
+    settings = SimpleNamespace(hardware=hardware, slicing=SimpleNamespace())
     printer = Printer(settings)
+    if state is not None:
+        printer.setState(state, rotations)
 
-    for line in lines:
-        line = line.strip()
-        if len(line) == 0:
-            continue
-        if line[0] == ";":  # comment
-            if line.startswith(";LAYER:"):
-                current_layer = int(line[7:])
-                printer.finishLayer()
-            elif line.startswith(";Estimated print time:"):
-                print_time = float(line[23:])
-                s.slicing.print_time = print_time
-            elif line.startswith(";Estimated consumption material:"):
-                consumption_material = float(line[33:])
-                s.slicing.consumption_material = consumption_material
-            elif line.startswith(";Planes contact with nozzle:"):
-                planes_contact_with_nozzle = line[29:]
-                s.slicing.planes_contact_with_nozzle = planes_contact_with_nozzle
-            elif line.startswith(";End"):
+    builder = GCodeBuilder()
+    for line in readMappedLines(filename, start, end):
+        if not parseMappedLine(printer, line, settings):
+            break
+        if printer.layers:
+            for layer in printer.popLayersData():
+                builder.addLayer(*layer)
+
+    printer.finishLayer()
+    for layer in printer.popLayersData():
+        builder.addLayer(*layer)
+
+    builder.pending_stats += printer.popStats()  # belongs to the next chunk
+    return builder.build(printer.rotations)
+
+
+LAZY_MIN_LAYERS = 2000
+
+
+def _blockPrints(mm, start, end, state, rotations, settings):
+    # whether the text between offsets has a printing move, so that Printer
+    # emits the layer of it, lines are replayed only up to such a move
+    scanner = ExtrusionScanner(settings)
+    scanner.setState(state, rotations)
+    mm.seek(start)
+    pos = start
+    while pos < end and not scanner.printed:
+        line = mm.readline()
+        pos += len(line)
+        if not parseMappedLine(scanner, line, settings):
+            break
+    return scanner.printed
+
+
+class LazyGCode:
+    """
+    G-code which is parsed layer by layer when the layers are requested
+
+    Only byte offsets of lines where layers end, ";LAYER:" lines and rotation
+    or incline markers, and the printer state at each of them are found up
+    front. The text before the first of them is parsed at once and gives the
+    same leading layers as GCode, then the text up to the next such line is a
+    block which gives one layer if it prints anything, as GCode drops layers
+    without printed paths, and the last layer is an empty dummy for back
+    rotations. A few layers after every requested one are parsed in
+    background. Times of layers after the head are not estimated and
+    layer_time is NaN for them.
+    """
+
+    def __init__(self, filename, settings=None, prefetch=4):
+        if settings is None:
+            settings = _default_settings()
+
+        self.filename = filename
+        self.scan = scanLayers(filename, settings)
+        marks, end, self.rotations = self.scan
+        self.hardware = _workerHardware(settings)
+        self.prefetch = prefetch
+
+        # block 0 is the head of the file, the others start at layer ends
+        self.starts = [0] + [offset for offset, _ in marks]
+        self.ends = self.starts[1:] + [end]
+        self.states = [None] + [state for _, state in marks]
+        self.head = self.parseBlock(0)
+
+        # blocks which print something, one per layer after the head
+        self.blocks = []
+        if marks:
+            block_settings = SimpleNamespace(
+                hardware=self.hardware, slicing=SimpleNamespace()
+            )
+            with open(filename, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    self.blocks = [
+                        i
+                        for i in range(1, len(self.starts))
+                        if _blockPrints(
+                            mm,
+                            self.starts[i],
+                            self.ends[i],
+                            self.states[i],
+                            self.rotations,
+                            block_settings,
+                        )
+                    ]
+
+        # a block ends with the rotation the next one starts with
+        rotations_counts = [state[2] for _, state in marks] + [len(self.rotations)]
+        self.lays2rots = self.head.lays2rots + [
+            rotations_counts[block] - 1 for block in self.blocks
+        ]
+        self.lays2rots.append(len(self.rotations) - 1)
+        self.layer_time = np.full(len(self.lays2rots), np.nan)
+        self.layer_time[: len(self.head.lays2rots)] = self.head.layer_time
+        self.layers = GCodeLayers(self)
+
+        self.futures = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def layer_points(self, idx):
+        """Return vertices of the layer and offsets of its paths starting from zero"""
+        if idx < len(self.head.lays2rots):
+            return self.head.layer_points(idx)
+
+        layer = idx - len(self.head.lays2rots)
+        for block in self.blocks[layer : layer + self.prefetch + 1]:
+            if block not in self.futures:
+                self.futures[block] = self.executor.submit(self.parseBlock, block)
+
+        gc = self.layerBlock(idx)
+        if gc is None:
+            return np.empty((0, 3)), np.zeros(1, dtype=np.int64)
+        return gc.layer_points(0)
+
+    def layer_path_types(self, idx):
+        """Return types of paths of the layer"""
+        if idx < len(self.head.lays2rots):
+            return self.head.layer_path_types(idx)
+
+        gc = self.layerBlock(idx)
+        if gc is None:
+            return np.empty(0, dtype=np.uint8)
+        return gc.layer_path_types(0)
+
+    def layer_path_stats(self, idx):
+        """Return (n, PATH_STATS) array with feed and flow of paths of the layer"""
+        if idx < len(self.head.lays2rots):
+            return self.head.layer_path_stats(idx)
+
+        gc = self.layerBlock(idx)
+        if gc is None:
+            return np.empty((0, PATH_STATS))
+        return gc.layer_path_stats(0)
+
+    def layerBlock(self, idx):
+        # parsed block of the layer after the head, None for the dummy layer
+        layer = idx - len(self.head.lays2rots)
+        if layer == len(self.blocks):
+            return None
+        block = self.blocks[layer]
+        if block not in self.futures:
+            self.futures[block] = self.executor.submit(self.parseBlock, block)
+        return self.futures[block].result()
+
+    def parseBlock(self, idx):
+        return _parseChunk(
+            self.filename,
+            self.starts[idx],
+            self.ends[idx],
+            self.states[idx],
+            self.rotations,
+            self.hardware,
+        )
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def readGCodeLazy(filename, settings=None, min_layers=LAZY_MIN_LAYERS, report=None):
+    """
+    Index the file and return LazyGCode for prints with at least min_layers
+    layers, smaller ones are parsed at once and report their progress
+    """
+    gc = LazyGCode(filename, settings)
+    if len(gc.layers) >= min_layers:
+        return gc
+
+    gc.close()
+    return readGCodeParallel(filename, settings=settings, scan=gc.scan, report=report)
+
+
+# bytes of a followed file read by one poll, bounds the time of a poll
+TAIL_READ_SIZE = 1 << 21
+
+
+class GCodeTail:
+    """
+    Parser which follows a G-code file while another process is writing it
+
+    poll() parses complete lines appended since the previous call, up to
+    max_bytes, and returns layers finished by then, caught_up tells whether
+    it reached the end of the file. finish() parses the rest once the writer
+    exits and returns the whole GCode. The file may appear after the tail is
+    created.
+    """
+
+    def __init__(self, filename, settings=None):
+        if settings is None:
+            settings = _default_settings()
+
+        self.filename = filename
+        self.settings = settings
+        self.printer = Printer(settings)
+        self.builder = GCodeBuilder()
+        self.offset = 0
+        self.tail = b""
+        self.ended = False
+        self.caught_up = True
+
+    @property
+    def rotations(self):
+        return self.printer.rotations
+
+    def poll(self, max_bytes=TAIL_READ_SIZE):
+        """Return list of (GCodeLayer, rotation index) of newly finished layers"""
+        if self.ended:
+            self.caught_up = True
+            return []
+        try:
+            with open(self.filename, "rb") as f:
+                f.seek(self.offset)
+                data = f.read(max_bytes)
+        except FileNotFoundError:
+            return []
+        self.offset += len(data)
+        self.caught_up = len(data) < max_bytes
+
+        data = self.tail + data
+        cut = data.rfind(b"\n") + 1
+        self.tail = data[cut:]
+        for line in data[:cut].decode("utf-8").split("\n"):
+            if not parseLine(self.printer, line, self.settings):
+                self.ended = True
                 break
-        if line == "T0":
-            t = 0
-        if line == "T1":
-            t = 1
-        if line == "T2":
-            t = 2
-        else:
-            line = line + ";" if len(line) == 0 or ";" not in line else line
-            args, comment = line.split(";")[:2]
-            args = args.split(" ")
-            if line.endswith("rotation-hack"):  # we pass U in the comment section
-                args, comment = line.split(";")[1:3]  # we remove first colon
-                args = args.split(" ")
-                printer.finishLayer()
-                printer.rotations.append(
-                    Rotation(printer.rotations[-1].x_rot, parseRotation(args[1:]))
-                )
-                printer.currPos.U = printer.rotations[-1].z_rot
-            elif line.endswith("rotation"):  # we have either rotation or incline
-                printer.finishLayer()
-                printer.rotations.append(
-                    Rotation(printer.rotations[-1].x_rot, parseRotation(args[1:]))
-                )
-                printer.currPos.U = printer.rotations[-1].z_rot
-            elif line.endswith("incline-hack"):
-                args, comment = line.split(";")[1:3]  # we remove first colon
-                args = args.split(" ")
-                printer.finishLayer()
-                printer.rotations.append(
-                    Rotation(parseRotation(args[1:]), printer.rotations[-1].z_rot)
-                )
 
-                printer.cone_axis = rotation_matrix(
-                    [1, 0, 0], np.radians(printer.rotations[-1].x_rot)
-                ).dot([0, 0, 1])
-                printer.currPos.V = printer.rotations[-1].x_rot
-            elif line.endswith("incline"):
-                printer.finishLayer()
-                printer.rotations.append(
-                    Rotation(parseRotation(args[1:]), printer.rotations[-1].z_rot)
-                )
+        return self.popLayers()
 
-                printer.cone_axis = rotation_matrix(
-                    [1, 0, 0], np.radians(printer.rotations[-1].x_rot)
-                ).dot([0, 0, 1])
-                printer.currPos.V = printer.rotations[-1].x_rot
-            elif args[0] == "G0":  # move to (or rotate)
-                pos = args[1:]
-
-                printer.updatePos(pos)
-            elif args[0] == "G1":  # draw to
-                pos = args[1:]
-
-                printer.updatePos(pos)
-            elif args[0] == "G90":  # absolute positioning
-                printer.abs_pos = True
-            elif args[0] == "G91":  # relative positioning
-                printer.abs_pos = False
-            elif args[0] == "G92":  # set position
-                printer.setAbsPos(args[1:])
-                printer.finishPath()
-            else:
-                pass  # skip
+    def finish(self):
+        self.poll()
+        while not self.caught_up:
+            self.poll()
+        if self.tail and not self.ended:
+            parseLine(self.printer, self.tail.decode("utf-8"), self.settings)
+        self.printer.finishLayer()
+        self.popLayers()
+
+        # dummy for back rotations, it gets moves after the last layer
+        self.builder.addLayer([], len(self.rotations) - 1, self.printer.popStats())
+        return self.builder.build(self.rotations)
+
+    def popLayers(self):
+        res = []
+        for paths, rotation, stats, types, path_stats in self.printer.popLayersData():
+            self.builder.addLayer(paths, rotation, stats, types, path_stats)
+            offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+            np.cumsum([len(path) for path in paths], out=offsets[1:])
+            points = np.concatenate(paths) if paths else np.empty((0, 3))
+            layer = GCodeLayer(
+                points,
+                offsets,
+                np.array(types, dtype=np.uint8),
+                np.array(path_stats, dtype=np.float64).reshape(-1, PATH_STATS),
+                self.builder.layer_stats[-1],  # time is the last of layer stats
+            )
+            res.append((layer, rotation))
+        return res
+
+
+def parseGCode(lines, settings=None, line_parser=None):
+    """
+    Parse an iterable of text lines, undecoded lines of readMappedLines
+    need line_parser=parseMappedLine
+    """
+    if settings is None:
+        settings = _default_settings()
+    if line_parser is None:
+        line_parser = parseLine
+
+    printer = Printer(settings)
+    builder = GCodeBuilder()
+    for line in lines:
+        if not line_parser(printer, line, settings):
+            break
+
+        if printer.layers:
+            for layer in printer.popLayersData():
+                builder.addLayer(*layer)
 
     printer.finishLayer()  # not forget about last layer
+    for layer in printer.popLayersData():
+        builder.addLayer(*layer)
+
+    # add dummy layer for back rotations, it gets moves after the last layer
+    builder.addLayer([], len(printer.rotations) - 1, printer.popStats())
+    return builder.build(printer.rotations)
+
+
+def _default_settings():
+    from src import settings as settings_module
+
+    return settings_module.sett()
+
+
+# X, Y, Z, U, V, E and F arguments of a command with the comment already cut off
+_VALUES_RE = re.compile(r"(?<!\S)([XYZUVEF])(\S*)")
+
+_TOOLS = {"T0": 0, "T1": 1, "T2": 2}
+
+
+def parseValues(args):
+    """Parse "X1 Y2.5 F1800 E0.1" into {"X": 1.0, "Y": 2.5, "F": 1800.0, "E": 0.1}"""
+    return {key: float(val) for key, val in _VALUES_RE.findall(args)}
+
+
+def parseLine(printer, line, s):
+    """Apply a single G-code line to the printer, returns False at the end of the print"""
+    line = line.strip()
+    if len(line) == 0:
+        return True
+    if line[0] == ";":  # comment
+        if line.startswith(";LAYER:"):
+            printer.current_layer = int(line[7:])
+            printer.finishLayer()
+        elif line.startswith(";Estimated print time:"):
+            print_time = float(line[23:])
+            s.slicing.print_time = print_time
+        elif line.startswith(";Estimated consumption material:"):
+            consumption_material = float(line[33:])
+            s.slicing.consumption_material = consumption_material
+        elif line.startswith(";Planes contact with nozzle:"):
+            planes_contact_with_nozzle = line[29:]
+            s.slicing.planes_contact_with_nozzle = planes_contact_with_nozzle
+        elif line.startswith(";End"):
+            return False
+    elif line in _TOOLS:
+        printer.tool = _TOOLS[line]
+        return True
+
+    if _isMarker(line):
+        parseMarker(printer, line)
+        return True
+
+    args = line.split(";", 1)[0]
+    code, _, args = args.partition(" ")
+    if code == "G1" or code == "G0":  # draw to, move to (or rotate)
+        printer.moveTo(parseValues(args))
+    elif code == "G90":  # absolute positioning
+        printer.abs_pos = True
+    elif code == "G91":  # relative positioning
+        printer.abs_pos = False
+    elif code == "G92":  # set position
+        values = parseValues(args)
+        values.pop("F", None)
+        printer.setAbsValues(values)
+        printer.finishPath()
+
+    return True
+
+
+_MAPPED_VALUES_RE = re.compile(rb"(?<!\S)([XYZUVEF])(\S*)")
+
+_MAPPED_KEYS = {key.encode(): key for key in "XYZUVEF"}
+
+
+def parseMappedLine(printer, line, s):
+    """
+    parseLine for undecoded lines, plain moves are parsed right from the bytes
+    and only their numeric fields are converted, other lines are decoded
+    """
+    line = line.strip()
+    if line[:3] in (b"G1 ", b"G0 ") and b";" not in line:
+        keys = _MAPPED_KEYS
+        values = {
+            keys[key]: float(val) for key, val in _MAPPED_VALUES_RE.findall(line, 3)
+        }
+        printer.moveTo(values)
+        return True
+    return parseLine(printer, line.decode("utf-8"), s)
+
+
+def parseMarker(printer, line):
+    # rotation and incline are set by G0 lines with a marker in the comment
+    if line.endswith("-hack"):  # we pass U or V in the comment section
+        args = line.split(";")[1]  # we remove first colon
+    else:
+        args = line.split(";")[0]
+    args = args.split(" ")
+
+    printer.finishLayer()
+    if line.endswith(("rotation", "rotation-hack")):
+        printer.rotations.append(
+            Rotation(printer.rotations[-1].x_rot, parseRotation(args[1:]))
+        )
+        printer.currPos.U = printer.rotations[-1].z_rot
+    else:
+        printer.rotations.append(
+            Rotation(parseRotation(args[1:]), printer.rotations[-1].z_rot)
+        )
 
-    printer.layers.append(layer)  # add dummy layer for back rotations
-    printer.lays2rots.append(len(printer.rotations) - 1)
-    return GCode(printer.layers, printer.rotations, printer.lays2rots)
+        printer.cone_axis = rotation_matrix(
+            [1, 0, 0], np.radians(printer.rotations[-1].x_rot)
+        ).dot([0, 0, 1])
+        printer.currPos.V = printer.rotations[-1].x_rot
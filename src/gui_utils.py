@@ -2,6 +2,7 @@ from typing import Tuple, List, Dict
 
 import vtk
 import numpy as np
+from vtk.util import numpy_support
 from PyQt5.QtWidgets import QMessageBox
 from vtkmodules.vtkCommonColor import vtkNamedColors
 from vtkmodules.vtkCommonMath import vtkMatrix4x4
@@ -264,49 +265,508 @@ def setTransformFromSettings(actor):
     return actor
 
 
-def makeBlocks(layers, rotations, lays2rots):
+def makeBlocks(layers):
     blocks = []
     for i in range(len(layers)):
-        points = vtk.vtkPoints()
-        lines = vtk.vtkCellArray()
         block = vtk.vtkPolyData()
-        points_count = 0
-        for path in layers[i]:
-            line = vtk.vtkLine()
-            for k in range(len(path) - 1):
-                points.InsertNextPoint(path[k].xyz(rotations[lays2rots[i]]))
-                line.GetPointIds().SetId(0, points_count + k)
-                line.GetPointIds().SetId(1, points_count + k + 1)
-                lines.InsertNextCell(line)
-            points.InsertNextPoint(
-                path[-1].xyz(rotations[lays2rots[i]])
-            )  # not forget to add last point
-            points_count += len(path)
-        block.SetPoints(points)
-        block.SetLines(lines)
+        fillBlock(block, layers[i])
         blocks.append(block)
     return blocks
 
 
-def wrapWithActors(blocks, rotations, lays2rots):
+def makeEmptyBlocks(count):
+    # placeholders for lazily parsed layers, filled with fillBlock later
+    return [vtk.vtkPolyData() for _ in range(count)]
+
+
+def fillBlock(block, layer):
+    # every path is a polyline over consecutive points of the layer
+    block.SetPoints(makePoints(layer.points))
+    block.SetLines(makePolylines(layer.path_offsets, np.arange(len(layer.points))))
+    times = np.full(len(layer.path_types), layer.time)
+    for name, values in cellValues(layer.path_types, layer.path_stats, times).items():
+        block.GetCellData().AddArray(makeCellArray(name, values))
+    block.Modified()
+
+
+def cellValues(path_types, path_stats, times):
+    """
+    Arrays of every COLOR_MODES name with values of cells, paths which are
+    not printed have NaN feed, flow and time
+    """
+    printed = path_types == 0  # gcode.PATH_EXTRUDE
+    return {
+        "type": np.asarray(path_types, dtype=np.uint8),
+        "feed": np.where(printed, path_stats[:, 0], np.nan).astype(np.float32),
+        "flow": np.where(printed, path_stats[:, 1], np.nan).astype(np.float32),
+        "time": np.where(printed, times, np.nan).astype(np.float32),
+    }
+
+
+def makeCellArray(name, values):
+    """vtk array sharing memory of values, named to be selected by mappers"""
+    array = numpy_support.numpy_to_vtk(np.ascontiguousarray(values), deep=False)
+    array.SetName(name)
+    return array
+
+
+def makePoints(points):
+    """vtkPoints sharing memory of (n, 3) array, it is kept alive by the vtk array"""
+    points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+    res = vtk.vtkPoints()
+    res.SetData(numpy_support.numpy_to_vtk(points, deep=False))
+    return res
+
+
+def makePolylines(offsets, connectivity):
+    """vtkCellArray with cells connectivity[offsets[i]:offsets[i + 1]]"""
+    lines = vtk.vtkCellArray()
+    lines.SetData(
+        numpy_support.numpy_to_vtkIdTypeArray(
+            np.ascontiguousarray(offsets, dtype=np.int64), deep=False
+        ),
+        numpy_support.numpy_to_vtkIdTypeArray(
+            np.ascontiguousarray(connectivity, dtype=np.int64), deep=False
+        ),
+    )
+    return lines
+
+
+def wrapWithActors(blocks, rotations, lays2rots, group_tfs=None, path_colors=None):
+    if group_tfs is None:
+        group_tfs = GroupTransforms(rotations, rotations[0])
+    if path_colors is None:
+        path_colors = PathColors()
+
     actors = []
     s = sett()
     for i in range(len(blocks)):
         block = blocks[i]
         actor = build_actor(block, True)
-        # rotate to abs coords firstly and then apply last rotation
-        tnf = prepareTransform(rotations[lays2rots[i]], rotations[0])
-        actor.SetUserTransform(tnf)
+        # layers of a rotation share the transform of its group
+        actor.SetUserTransform(group_tfs.get(lays2rots[i]))
 
         actor.GetProperty().SetColor(get_color(s.colors.layer))
         actor.GetProperty().SetOpacity(sett().common.opacity_layer)
+        path_colors.apply(actor)
         actors.append(actor)
 
     actors[-1].GetProperty().SetColor(get_color(s.colors.last_layer))
     actors[-1].GetProperty().SetOpacity(sett().common.opacity_last_layer)
+    path_colors.apply(actors[-1], last=True)
     return actors
 
 
+# names of cell data arrays G-code paths may be colored by: path type,
+# feed rate, flow (E per mm) and estimated time of the layer
+COLOR_MODES = ("type", "feed", "flow", "time")
+# share of values beyond each end of the color scale
+COLOR_RANGE_OUTLIERS = 0.02
+
+
+class PathColors:
+    """
+    Lookup tables which color G-code paths by one of COLOR_MODES cell arrays
+
+    In the "type" mode printed paths get the color of layers or of the last
+    layer, travels and retractions get colors.travel and colors.retract.
+    Other modes map values of printed paths from blue to red, travels and
+    retractions are NaN there and get colors.travel. Hidden types have zero
+    alpha and every mode only selects another array of the same polydata, so
+    neither toggling nor switching rebuilds any geometry. Entries of the type
+    tables are indexed by gcode.PATH_* codes.
+    """
+
+    def __init__(self):
+        self.mode = "type"
+        self.visible = [True, False, False]  # travels are hidden by default
+        self.layer = vtk.vtkLookupTable()
+        self.last_layer = vtk.vtkLookupTable()
+        self.values = {}
+        for mode in COLOR_MODES[1:]:
+            table = vtk.vtkLookupTable()
+            table.SetHueRange(0.667, 0)
+            table.SetTableRange(0, 1)
+            table.Build()
+            self.values[mode] = table
+        self.ranges = {}  # fitted (low, high) of every value table
+        self.update()
+
+    def setVisible(self, path_type, visible):
+        self.visible[path_type] = visible
+        self.update()
+
+    def setMode(self, mode):
+        self.mode = mode
+
+    def table(self):
+        """Lookup table of values for the current mode, None for the type mode"""
+        return self.values.get(self.mode)
+
+    def reset(self):
+        """Forget the fitted ranges, values of other G-code are coming"""
+        self.ranges = {}
+        for table in self.values.values():
+            table.SetTableRange(0, 1)
+
+    def fit(self, gc):
+        """Stretch the value tables over values of printed paths of G-code"""
+        self.reset()
+        printed = gc.path_types == 0  # gcode.PATH_EXTRUDE
+        self.widen(
+            {
+                "feed": gc.path_feed[printed],
+                "flow": gc.path_flow[printed],
+                "time": gc.layer_time[gc.layer_time > 0],  # not the empty ones
+            }
+        )
+
+    def fitBlock(self, block):
+        """
+        Widen the value tables over a block filled by fillBlock, for G-code
+        which is shown before all of its layers are parsed
+        """
+        data = block.GetCellData()
+        self.widen(
+            {
+                mode: numpy_support.vtk_to_numpy(data.GetArray(mode))
+                for mode in self.values
+            }
+        )
+
+    def widen(self, values):
+        # the range of every table only grows to cover the values
+        for mode, table in self.values.items():
+            known = values[mode][np.isfinite(values[mode])]
+            if len(known) == 0:
+                continue
+            low, high = np.quantile(
+                known, [COLOR_RANGE_OUTLIERS, 1 - COLOR_RANGE_OUTLIERS]
+            )
+            if mode in self.ranges:
+                fitted_low, fitted_high = self.ranges[mode]
+                low, high = min(low, fitted_low), max(high, fitted_high)
+            self.ranges[mode] = low, high
+            table.SetTableRange(low, max(high, low + 1e-6))
+
+    def update(self):
+        s = sett()
+        for table, color in (
+            (self.layer, s.colors.layer),
+            (self.last_layer, s.colors.last_layer),
+        ):
+            table.SetNumberOfTableValues(len(self.visible))
+            table.SetTableRange(0, len(self.visible) - 1)
+            colors = (color, s.colors.travel, s.colors.retract)
+            for path_type, (name, visible) in enumerate(zip(colors, self.visible)):
+                table.SetTableValue(path_type, *get_color(name), float(visible))
+            table.Modified()
+
+        for table in self.values.values():
+            table.SetNanColor(*get_color(s.colors.travel), float(self.visible[1]))
+            table.Modified()
+
+    def apply(self, actor, last=False):
+        """Color paths of the actor by the array of the current mode"""
+        mapper = actor.GetMapper()
+        table = self.table()
+        if table is None:
+            table = self.last_layer if last else self.layer
+        mapper.SetLookupTable(table)
+        mapper.UseLookupTableScalarRangeOn()
+        mapper.SetScalarModeToUseCellFieldData()
+        mapper.SelectColorArray(self.mode)
+        # uint8 scalars would be taken as colors themselves
+        mapper.SetColorModeToMapScalars()
+        mapper.ScalarVisibilityOn()
+
+
+def simplifyPaths(points, offsets, tolerance):
+    """
+    Douglas-Peucker simplification of polylines points[offsets[i]:offsets[i + 1]]
+
+    All polylines are processed at once: every pass splits the pending spans of
+    all paths at their farthest point. Returns a mask of points to keep, ends of
+    every path are always kept.
+    """
+    keep = np.zeros(len(points), dtype=bool)
+    starts, ends = offsets[:-1], offsets[1:] - 1
+    starts, ends = starts[ends >= starts], ends[ends >= starts]
+    keep[starts] = True
+    keep[ends] = True
+
+    while True:
+        pending = ends - starts > 1
+        starts, ends = starts[pending], ends[pending]
+        if len(starts) == 0:
+            return keep
+
+        # inner points of every span and the span they belong to
+        counts = ends - starts - 1
+        spans = np.repeat(np.arange(len(starts)), counts)
+        firsts = np.cumsum(counts) - counts
+        inner = starts[spans] + 1 + np.arange(len(spans)) - firsts[spans]
+
+        a, b, p = points[starts[spans]], points[ends[spans]], points[inner]
+        ab = b - a
+        length = np.einsum("ij,ij->i", ab, ab)
+        t = np.einsum("ij,ij->i", p - a, ab) / np.where(length > 0, length, 1)
+        nearest = a + ab * np.clip(t, 0, 1)[:, None]
+        distance = np.linalg.norm(p - nearest, axis=1)
+
+        # the last point of every span in this order is the farthest one
+        farthest = np.lexsort((distance, spans))[firsts + counts - 1]
+        split = distance[farthest] > tolerance
+        middles = inner[farthest[split]]
+        keep[middles] = True
+        starts, ends = (
+            np.concatenate([starts[split], middles]),
+            np.concatenate([middles, ends[split]]),
+        )
+
+
+class GroupTransforms:
+    """
+    One vtkTransform per rotation of G-code shared by all layers of the rotation
+
+    Every transform reverts the rotation of its layers and applies the current
+    one, so a rotation change updates a transform per rotation group instead
+    of the user transform of every layer actor.
+    """
+
+    def __init__(self, rotations, curr_rotation):
+        self.rotations = rotations  # may grow while G-code is being sliced
+        self.curr_rotation = curr_rotation
+        self.transforms = {}
+
+    def get(self, rotation):
+        tf = self.transforms.get(rotation)
+        if tf is None:
+            tf = vtk.vtkTransform()
+            self.update(rotation, tf)
+            self.transforms[rotation] = tf
+        return tf
+
+    def rotate(self, curr_rotation):
+        if curr_rotation is self.curr_rotation:
+            return
+        self.curr_rotation = curr_rotation
+        for rotation, tf in self.transforms.items():
+            self.update(rotation, tf)
+
+    def update(self, rotation, tf):
+        # rotate to abs coords firstly and then apply current rotation
+        cached = transforms.get(self.rotations[rotation], self.curr_rotation)
+        tf.SetMatrix(cached.GetMatrix())
+
+
+# allowed deviations of simplified paths for every level of detail, mm
+LOD_TOLERANCES = (0.05, 0.2, 0.8)
+# deviation which is not visible from the distance 1 to focal point
+LOD_DISTANCE_FACTOR = 0.001
+
+
+def lodLevel(distance):
+    """Level of detail for the camera distance, 0 is the full detail"""
+    tolerance = distance * LOD_DISTANCE_FACTOR
+    return sum(1 for t in LOD_TOLERANCES if t <= tolerance)
+
+
+class LayerGroups:
+    """
+    G-code layers merged into one polydata per rotation
+
+    Every path is a polyline cell and cells are ordered by layers, the layer of
+    every cell is stored in the "layer" cell data array and the values it may
+    be colored by in arrays named by COLOR_MODES. Layers below the slider
+    are shown by clamping cells of each group to a prefix, the current layer is
+    drawn by a separate highlight actor. Both share points of the group.
+
+    Far from the camera layers are drawn with simplified paths, see setDistance,
+    the highlighted layer is always drawn in full detail.
+
+    Geometry of groups may be prepared in a worker thread by build and passed
+    here, only actors are created by the constructor. Paths are colored by
+    their types with path_colors, see PathColors.
+    """
+
+    def __init__(self, gc, groups=None, level=0, path_colors=None):
+        self.rotations = gc.rotations
+        self.lays2rots = list(gc.lays2rots)
+        self.layers_count = len(self.lays2rots)
+        if groups is None:
+            groups = list(self.build(gc, level))
+
+        if path_colors is None:
+            path_colors = PathColors()
+        self.path_colors = path_colors
+
+        s = sett()
+        self.group_tfs = GroupTransforms(self.rotations, self.rotations[0])
+        self.groups = groups
+        for group in self.groups:
+            group.level = level
+            group.actor = ActorFromPolyData(group.cells(0, group.layer_cells[-1]))
+            group.actor.SetUserTransform(self.group_tfs.get(group.rotation))
+            group.actor.GetProperty().SetColor(get_color(s.colors.layer))
+            group.actor.GetProperty().SetOpacity(s.common.opacity_layer)
+
+        self.highlight = ActorFromPolyData(vtk.vtkPolyData())
+        self.highlight.GetProperty().SetColor(get_color(s.colors.last_layer))
+        self.highlight.GetProperty().SetLineWidth(4)
+        self.highlight.GetProperty().SetOpacity(s.common.opacity_last_layer)
+
+        self.actors = [group.actor for group in self.groups] + [self.highlight]
+        self.applyColors()
+        self.level = level
+        self.show(self.layers_count)
+
+    @staticmethod
+    def build(gc, level=0, progress=None):
+        """
+        Yield LayerGroup of every rotation with paths for the level of detail
+
+        No actors are created, so it is safe to run in a worker thread.
+        progress is called with the number of layers processed so far.
+        """
+        lays2rots = np.asarray(gc.lays2rots)
+        done = 0
+        for rotation in np.unique(lays2rots).tolist():
+            layers = np.flatnonzero(lays2rots == rotation)
+            group = LayerGroup(
+                gc,
+                rotation,
+                layers,
+                progress and (lambda count, done=done: progress(done + count)),
+            )
+            group.paths(level)
+            done += len(layers)
+            yield group
+
+    def setDistance(self, distance):
+        """Choose level of detail for the camera distance, True when it changed"""
+        level = lodLevel(distance)
+        if level == self.level:
+            return False
+
+        self.level = level
+        for group in self.groups:
+            group.level = level
+        self.show(self.value)
+        return True
+
+    def show(self, value):
+        """Show layers below value and highlight the layer value like change_layer_view"""
+        self.value = value
+        last = value >= self.layers_count
+        self.group_tfs.rotate(self.rotations[self.lays2rots[0 if last else value]])
+
+        for group in self.groups:
+            group.showLayers(value + 1 if last else value)
+
+        if last:
+            self.highlight.GetMapper().SetInputData(vtk.vtkPolyData())
+            return
+
+        rotation = self.lays2rots[value]
+        group = next(group for group in self.groups if group.rotation == rotation)
+        self.highlight.GetMapper().SetInputData(group.layer(value))
+        self.highlight.SetUserTransform(self.group_tfs.get(rotation))
+
+    def setVisible(self, visible):
+        for actor in self.actors:
+            actor.SetVisibility(visible)
+
+    def applyColors(self):
+        """Color actors by the current mode of path_colors"""
+        for group in self.groups:
+            self.path_colors.apply(group.actor)
+        self.path_colors.apply(self.highlight, last=True)
+
+
+class LayerGroup:
+    """Layers printed with the same rotation as polylines in shared arrays"""
+
+    def __init__(self, gc, rotation, layers, progress=None):
+        self.rotation = rotation
+        self.layers = layers
+
+        points = [np.empty((0, 3))]
+        path_offsets = [np.zeros(1, dtype=np.int64)]
+        path_types = [np.empty(0, dtype=np.uint8)]
+        path_stats = [np.empty((0, 2))]
+        cells_count = np.zeros(len(layers), dtype=np.int64)
+        points_count = 0
+        for i, layer in enumerate(layers.tolist()):
+            layer_points, offsets = gc.layer_points(layer)
+            points.append(layer_points)
+            path_types.append(gc.layer_path_types(layer))
+            path_stats.append(gc.layer_path_stats(layer))
+            path_offsets.append(offsets[1:] + points_count)
+            cells_count[i] = len(offsets) - 1
+            points_count += len(layer_points)
+            if progress:
+                progress(i + 1)
+
+        self.offsets = np.concatenate(path_offsets)
+        self.connectivity = np.arange(points_count, dtype=np.int64)
+        # (offsets, connectivity) of paths for every level of detail
+        self.levels = {0: (self.offsets, self.connectivity)}
+        self.level = 0
+        self.cell_layers = np.repeat(layers, cells_count).astype(np.int32)
+        # arrays of COLOR_MODES values of every cell
+        self.cell_values = cellValues(
+            np.concatenate(path_types),
+            np.concatenate(path_stats),
+            np.repeat(np.asarray(gc.layer_time)[layers], cells_count),
+        )
+        # cells of the i-th layer of the group are layer_cells[i]:layer_cells[i + 1]
+        self.layer_cells = np.concatenate([[0], np.cumsum(cells_count)])
+
+        self.points = np.concatenate(points)
+        self.vtk_points = makePoints(self.points)
+        self.actor = None  # created by LayerGroups
+
+    def paths(self, level):
+        """Offsets and connectivity of paths simplified for the level of detail"""
+        if level not in self.levels:
+            tolerance = LOD_TOLERANCES[level - 1]
+            connectivity = np.flatnonzero(
+                simplifyPaths(self.points, self.offsets, tolerance)
+            )
+            # every path keeps its first point, so cells stay the same
+            offsets = np.searchsorted(connectivity, self.offsets)
+            self.levels[level] = (offsets, connectivity)
+        return self.levels[level]
+
+    def cells(self, first, last, level=None):
+        """Polydata with the cells first:last of the group"""
+        all_offsets, connectivity = self.paths(self.level if level is None else level)
+        offsets = all_offsets[first : last + 1]
+        begin, end = offsets[0], offsets[-1]
+        if begin > 0:
+            offsets = offsets - begin
+        lines = makePolylines(offsets, connectivity[begin:end])
+        cell_layers = makeCellArray("layer", self.cell_layers[first:last])
+
+        block = vtk.vtkPolyData()
+        block.SetPoints(self.vtk_points)
+        block.SetLines(lines)
+        block.GetCellData().AddArray(cell_layers)
+        for name, values in self.cell_values.items():
+            block.GetCellData().AddArray(makeCellArray(name, values[first:last]))
+        return block
+
+    def showLayers(self, value):
+        """Show layers of the group which are below value"""
+        visible = self.layer_cells[np.searchsorted(self.layers, value)]
+        self.actor.GetMapper().SetInputData(self.cells(0, visible))
+
+    def layer(self, layer):
+        i = np.searchsorted(self.layers, layer)
+        return self.cells(self.layer_cells[i], self.layer_cells[i + 1], level=0)
+
+
 #  R(V - rotcentr) + rotcenter
 def prepareTransform(cancelRot, applyRot):
     sh = sett().hardware
@@ -333,6 +793,43 @@ def prepareTransform(cancelRot, applyRot):
     return tf
 
 
+class TransformCache:
+    """
+    Transforms built by prepareTransform cached by values of both rotations
+
+    G-code blocks and the layers view request the same few pairs of rotations
+    for thousands of layers, so every pair is computed only once. Returned
+    transforms are shared and must not be modified.
+    """
+
+    def __init__(self):
+        self.transforms = {}
+
+    @staticmethod
+    def key(cancelRot, applyRot):
+        sh = sett().hardware
+        return (
+            cancelRot.x_rot,
+            cancelRot.z_rot,
+            applyRot.x_rot,
+            applyRot.z_rot,
+            sh.rotation_center_x,
+            sh.rotation_center_y,
+            sh.rotation_center_z,
+        )
+
+    def get(self, cancelRot, applyRot):
+        key = self.key(cancelRot, applyRot)
+        tf = self.transforms.get(key)
+        if tf is None:
+            tf = prepareTransform(cancelRot, applyRot)
+            self.transforms[key] = tf
+        return tf
+
+
+transforms = TransformCache()
+
+
 def plane_tf(rotation):
     sh = sett().hardware
     tf = vtk.vtkTransform()
@@ -24,6 +24,9 @@ class Locale:
     FillingType = "Filling type:"
     FillingTypeValues = ["Lines", "Squares", "Triangles", "Cross", "ZigZag"]
     ShowStl = "Show stl"
+    ShowTravels = "Show travels"
+    ColorMode = "Color by:"
+    ColorModeValues = ["Path type", "Speed", "Flow", "Layer time"]
     LayersCount = "Layers count:"
     OpenModel = "Open model"
     ColorModel = "Highlight critical overhangs"
@@ -93,8 +96,6 @@ class Locale:
     SlicerInfo = "Slicer info"
     SlicerVersion = "Slicer version: "
     Documentation = "Show online documentation"
-    SlicingTitle = "Slicing"
-    SlicingProgress = "Slicing is in progress..."
     GCodeLoadingTitle = "GCode loading"
     GCodeLoadingProgress = "GCode loading is in progress..."
     SupportsSettings = "Supports settings"
@@ -205,6 +206,9 @@ dicts = {
         NumberOfLidLayers="Количество слоев крышки:",
         LineWidth="Диаметр сопла, мм:",
         ShowStl="Отображение STL модели",
+        ShowTravels="Отображение перемещений",
+        ColorMode="Цвет по:",
+        ColorModeValues=["Тип пути", "Скорость", "Поток", "Время слоя"],
         LayersCount="Отображаемые слои:",
         FillingType="Тип заполнения:",
         FillingTypeValues=[
@@ -283,8 +287,6 @@ dicts = {
         SlicerInfo="Информация о слайсере",
         SlicerVersion="Версия слайсера: ",
         Documentation="Открыть онлайн документацию",
-        SlicingTitle="Слайсинг",
-        SlicingProgress="Слайсинг в прогрессе...",
         GCodeLoadingTitle="Загрузка GCode",
         GCodeLoadingProgress="Загрузка GCode в прогрессе...",
         SupportsSettings="Настройки поддержек",
@@ -13,10 +13,25 @@ class MainModel:
 
         self.figures_setts = []
 
-    def load_gcode(self, filename):
+    def load_gcode(self, filename, report=None):
+        # report is called with the byte offset parsed so far
         self.current_slider_value = None
         self.opened_gcode = filename
-        self.gcode = gcode.readGCode(filename)
+        if isinstance(self.gcode, gcode.LazyGCode):
+            self.gcode.close()
+        self.gcode = gcode.readGCodeCached(
+            filename, reader=gcode.readGCodeLazy, report=report
+        )
+        return self.gcode
+
+    def set_gcode(self, filename, gc):
+        # G-code parsed while slicing, it is stored for the next loads
+        self.current_slider_value = None
+        self.opened_gcode = filename
+        if isinstance(self.gcode, gcode.LazyGCode):
+            self.gcode.close()
+        self.gcode = gc
+        gcode.storeCache(gc, filename)
         return self.gcode
 
     def add_splane(self):
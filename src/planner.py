@@ -0,0 +1,93 @@
+"""
+Print time estimation by simulation of the printer motion planner
+
+Every move accelerates from its entry speed to its nominal speed, cruises and
+decelerates to its exit speed. Junction speeds between moves are limited by
+the jerk of every axis, then look-ahead lowers them so that every move can
+reach the speed of the next one within its length. Both look-ahead passes are
+minimums of prefix sums, so all moves are planned at once.
+"""
+
+import numpy as np
+
+from src import gcode
+
+AXES = "XYZUVE"
+
+
+def planMoves(deltas, feeds, hardware):
+    """
+    Return durations of moves in seconds
+
+    deltas - (M, 6) array of X, Y, Z, U, V, E changes of every move, mm or deg
+    feeds - (M) array of feed rates in mm/s, nan means the maximal speed
+    hardware - settings with max_speed, acceleration, max_jerk and
+    minimum_planner_speed
+    """
+    limits = gcode.MotionLimits(hardware)
+    max_speed = np.array([limits.speed[axis] for axis in AXES])
+    max_acceleration = np.array([limits.acceleration[axis] for axis in AXES])
+    max_jerk = np.array([limits.jerk[axis] for axis in AXES])
+
+    deltas = np.asarray(deltas, dtype=np.float64).reshape(-1, len(AXES))
+    feeds = np.asarray(feeds, dtype=np.float64)
+    durations = np.zeros(len(deltas))
+
+    # the feed rate is given along XYZ, along the rotary axes if only they
+    # move and along E for retractions
+    length = np.linalg.norm(deltas[:, :3], axis=1)
+    rotary = np.linalg.norm(deltas[:, 3:5], axis=1)
+    length = np.where(length > 0, length, rotary)
+    length = np.where(length > 0, length, np.abs(deltas[:, 5]))
+    moving = length > 0
+    if not moving.any():
+        return durations
+    deltas, feeds, length = deltas[moving], feeds[moving], length[moving]
+
+    # every axis limits the move by its share of the move length
+    direction = deltas / length[:, None]
+    share = np.abs(direction)
+    speed = np.fmin(feeds, _minRatio(max_speed, share))
+    acceleration = _minRatio(max_acceleration, share)
+
+    # at junctions and at both ends velocity of every axis jumps at most by jerk
+    jump = np.abs(np.diff(direction, axis=0, prepend=0, append=0))
+    junction = np.maximum(_minRatio(max_jerk, jump), hardware.minimum_planner_speed)
+    junction[:-1] = np.minimum(junction[:-1], speed)
+    junction[1:] = np.minimum(junction[1:], speed)
+
+    # look-ahead on squared speeds: v[k]^2 <= v[m]^2 + 2 a L of moves between them,
+    # with reach prefix sums it is a suffix (backward) and prefix (forward) minimum
+    reach = 2 * acceleration * length
+    reached = np.concatenate([[0], np.cumsum(reach)])
+    squared = junction**2 + reached
+    squared = np.minimum.accumulate(squared[::-1])[::-1] - reached
+    squared = np.minimum.accumulate(squared - reached) + reached
+    squared = np.maximum(squared, 0)
+    entry, exit = squared[:-1], squared[1:]
+
+    # trapezoid when the nominal speed is reached, triangle otherwise
+    top = speed**2
+    cruise = length - (2 * top - entry - exit) / (2 * acceleration)
+    peak = np.sqrt(np.where(cruise > 0, top, (reach + entry + exit) / 2))
+    durations[moving] = (2 * peak - np.sqrt(entry) - np.sqrt(exit)) / acceleration
+    durations[moving] += np.maximum(cruise, 0) / speed
+    return durations
+
+
+def _minRatio(limits, shares):
+    # min over axes of limit / share, axes which do not move do not limit
+    ratio = np.divide(
+        limits, shares, out=np.full(shares.shape, np.inf), where=shares > 0
+    )
+    return ratio.min(axis=1)
+
+
+def estimatePrintTime(filename, settings=None):
+    """Return total print time of the G-code file in seconds and move durations"""
+    if settings is None:
+        settings = gcode._default_settings()
+
+    deltas, feeds = gcode.readMoves(filename, settings)
+    durations = planMoves(deltas, feeds, settings.hardware)
+    return float(durations.sum()), durations
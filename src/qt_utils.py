@@ -19,6 +19,7 @@ class ClickableLineEdit(QLineEdit):
 class TaskManager(QtCore.QObject):
     # source: https://stackoverflow.com/questions/64500883/pyqt5-widget-qthread-issue-when-using-concurrent-futures-threadpoolexecutor
     finished = QtCore.pyqtSignal(object)
+    progress = QtCore.pyqtSignal(int, object)
 
     def __init__(self, parent=None, max_workers=None):
         super().__init__(parent)
@@ -95,10 +96,20 @@ class LineEdit(QLineEdit):
                 )
 
 
-def progress_dialog(title, msg, work_fn, parent=None):
-    """Show a blocking progress dialog while executing work in background thread"""
-    progress = QProgressDialog(msg, None, 0, 0, parent=parent)
+def progress_dialog(title, msg, work_fn, parent=None, on_progress=None):
+    """
+    Show a blocking progress dialog while executing work in background thread
+
+    With on_progress the dialog shows percentage, work_fn is called with
+    report(percent, data=None) and every reported data is passed
+    to on_progress in the GUI thread
+    """
+    progress = QProgressDialog(
+        msg, None, 0, 0 if on_progress is None else 100, parent=parent
+    )
     progress.setWindowTitle(title)
+    progress.setAutoClose(False)
+    progress.setAutoReset(False)
 
     manager = TaskManager(max_workers=1)
     result = []
@@ -107,9 +118,22 @@ def progress_dialog(title, msg, work_fn, parent=None):
         progress.accept()
         result.append(v)
 
+    def task_progressed(percent, data):
+        progress.setValue(percent)
+        if data is not None:
+            on_progress(data)
+
     manager.finished.connect(task_finished)
 
-    manager.submit(work_fn)
+    if on_progress is None:
+        manager.submit(work_fn)
+    else:
+        manager.progress.connect(task_progressed)
+
+        def report(percent, data=None):
+            manager.progress.emit(int(percent), data)
+
+        manager.submit(work_fn, report)
     _exec_dialog(progress)
 
     return result[0]
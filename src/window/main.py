@@ -10,6 +10,7 @@ from PyQt5.QtWidgets import (
     QGridLayout,
     QSlider,
     QCheckBox,
+    QComboBox,
     QVBoxLayout,
     QPushButton,
     QScrollArea,
@@ -23,7 +24,7 @@ from PyQt5.QtWidgets import (
     QMessageBox,
 )
 
-from src import locales, gui_utils
+from src import gcode, locales, gui_utils
 from src.gui_utils import plane_tf, Plane, Cone, showErrorDialog
 from src.settings import (
     sett,
@@ -176,6 +177,10 @@ class MainWindow(QMainWindow):
 
         # ###################TODO:
         self.actors = []
+        self.layer_groups = None  # layers merged by rotations, see load_gcode
+        self.group_tfs = None  # transforms shared by layer actors of a rotation
+        self.unbuilt_layers = set()  # lazily parsed layers without geometry yet
+        self.path_colors = gui_utils.PathColors()  # shared by all G-code actors
         self.stlActor = None
         # self.colorizeModel()
 
@@ -239,6 +244,15 @@ class MainWindow(QMainWindow):
 
         self.render.AddActor(self.legend)
 
+    def add_color_bar(self):
+        # scale of values G-code is colored by, hidden for path types
+        self.color_bar = vtk.vtkScalarBarActor()
+        self.color_bar.SetNumberOfLabels(5)
+        self.color_bar.SetMaximumWidthInPixels(80)
+        self.color_bar.GetPositionCoordinate().SetValue(0.9, 0.1)
+        self.color_bar.VisibilityOff()
+        self.render.AddActor(self.color_bar)
+
     def init_right_panel(self):
         right_panel = QGridLayout()
         right_panel.setSpacing(5)
@@ -289,6 +303,14 @@ class MainWindow(QMainWindow):
         self.model_align_height = QCheckBox(self.locale.AlignModelHeight)
         self.model_align_height.setChecked(True)
         buttons_layout.addWidget(self.model_align_height, get_next_row(), 1)
+        self.show_travels_box = QCheckBox(self.locale.ShowTravels)
+        buttons_layout.addWidget(self.show_travels_box, get_cur_row(), 2)
+
+        self.color_mode_label = QLabel(self.locale.ColorMode)
+        buttons_layout.addWidget(self.color_mode_label, get_next_row(), 1)
+        self.color_mode_box = QComboBox()
+        self.color_mode_box.addItems(self.locale.ColorModeValues)
+        buttons_layout.addWidget(self.color_mode_box, get_cur_row(), 2)
 
         self.slider_label = QLabel(self.locale.LayersCount)
         self.layers_number_label = QLabel()
@@ -474,6 +496,9 @@ class MainWindow(QMainWindow):
             for actor in self.actors:
                 actor.VisibilityOff()
             self.stlActor.VisibilityOn()
+        elif self.layer_groups is not None:
+            self.layer_groups.setVisible(True)
+            self.stlActor.VisibilityOff()
         else:
             for layer in range(self.picture_slider.value()):
                 self.actors[layer].VisibilityOn()
@@ -518,22 +543,64 @@ class MainWindow(QMainWindow):
         self.render.RemoveAllViewProps()
         self.render.AddActor(self.planeActor)
         self.render.AddActor(self.legend)
+        self.render.AddActor(self.color_bar)
         self.rotate_plane(vtk.vtkTransform())
 
     def reload_scene(self):
         self.render.Modified()
         self.interactor.Render()
 
+    def show_travels(self):
+        # travels are hidden by the lookup tables, the geometry stays the same
+        visible = self.show_travels_box.isChecked()
+        for path_type in (gcode.PATH_TRAVEL, gcode.PATH_RETRACT):
+            self.path_colors.setVisible(path_type, visible)
+        self.reload_scene()
+
+    def change_color_mode(self, index):
+        # modes select other cell arrays of the same polydata, nothing is rebuilt
+        mode = gui_utils.COLOR_MODES[index]
+        self.path_colors.setMode(mode)
+        if self.layer_groups is not None:
+            self.layer_groups.applyColors()
+        else:
+            last = len(self.actors) - 1
+            if self.picture_slider.isEnabled():
+                last = self.picture_slider.value()
+            for i, actor in enumerate(self.actors):
+                self.path_colors.apply(actor, last=i == last)
+
+        table = self.path_colors.table()
+        if table is not None:
+            self.color_bar.SetLookupTable(table)
+            self.color_bar.SetTitle(self.color_mode_box.currentText())
+        self.color_bar.SetVisibility(table is not None)
+        self.reload_scene()
+
+    def update_gcode_detail(self, distance):
+        # simplified layers are shown when the camera is far from them
+        if self.layer_groups is not None:
+            self.layer_groups.setDistance(distance)
+
     def change_layer_view(
         self, new_slider_value, prev_value, gcd
     ):  # shows +1 layer to preview finish
         if prev_value is None:
             return new_slider_value
 
+        if self.layer_groups is not None:
+            self.layer_groups.show(new_slider_value)
+            self.layers_number_label.setText(str(new_slider_value))
+            last = new_slider_value >= self.layer_groups.layers_count
+            new_rot = gcd.lays2rots[0] if last else gcd.lays2rots[new_slider_value]
+            self.rotate_plane(plane_tf(gcd.rotations[new_rot]))
+            return new_slider_value
+
         last = False if len(self.actors) > new_slider_value else True
         prev_last = False if len(self.actors) > prev_value else True
 
         if not last:
+            self.build_layer(new_slider_value, gcd)
             self.actors[new_slider_value].GetProperty().SetColor(
                 get_color(sett().colors.last_layer)
             )
@@ -541,6 +608,7 @@ class MainWindow(QMainWindow):
             self.actors[new_slider_value].GetProperty().SetOpacity(
                 sett().common.opacity_last_layer
             )
+            self.path_colors.apply(self.actors[new_slider_value], last=True)
         if not prev_last:
             self.actors[prev_value].GetProperty().SetColor(
                 get_color(sett().colors.layer)
@@ -549,6 +617,7 @@ class MainWindow(QMainWindow):
             self.actors[prev_value].GetProperty().SetOpacity(
                 sett().common.opacity_layer
             )
+            self.path_colors.apply(self.actors[prev_value])
 
         self.layers_number_label.setText(str(new_slider_value))
 
@@ -561,6 +630,7 @@ class MainWindow(QMainWindow):
             for layer in range(
                 prev_value, new_slider_value if last else new_slider_value + 1
             ):
+                self.build_layer(layer, gcd)
                 self.actors[layer].VisibilityOn()
 
         new_rot = gcd.lays2rots[0] if last else gcd.lays2rots[new_slider_value]
@@ -568,12 +638,8 @@ class MainWindow(QMainWindow):
 
         if new_rot != prev_rot:
             curr_rotation = gcd.rotations[new_rot]
-            for block in range(new_slider_value if last else new_slider_value + 1):
-                # revert prev rotation firstly and then apply current
-                tf = gui_utils.prepareTransform(
-                    gcd.rotations[gcd.lays2rots[block]], curr_rotation
-                )
-                self.actors[block].SetUserTransform(tf)
+            # layers of a rotation share one transform, see GroupTransforms
+            self.group_tfs.rotate(curr_rotation)
 
             self.rotate_plane(plane_tf(curr_rotation))
             # for i in range(len(self.planes)):
@@ -864,7 +930,9 @@ class MainWindow(QMainWindow):
         )
         self.reload_scene()
 
-    def load_gcode(self, actors, is_from_stl, plane_tf):
+    def load_gcode(
+        self, actors, is_from_stl, plane_tf, lazy_gcode=None, group_tfs=None
+    ):
         self.reset_colorize()
         self.clear_scene()
         if is_from_stl:
@@ -874,18 +942,120 @@ class MainWindow(QMainWindow):
         if plane_tf:
             self.rotate_plane(plane_tf)
 
+        # fully parsed G-code comes as LayerGroups, the others as actor per layer
+        self.layer_groups = None
+        if isinstance(actors, gui_utils.LayerGroups):
+            self.layer_groups = actors
+            self.update_gcode_detail(self.customInteractor.distanceToFocal)
+            layers_count = actors.layers_count
+            actors = actors.actors
+        else:
+            self.group_tfs = group_tfs
+            layers_count = len(actors)
+
         self.actors = actors
         for actor in self.actors:
             self.render.AddActor(actor)
 
+        # lazily parsed layers are built when the slider reaches them,
+        # so the view starts from the first layer instead of the whole print
+        slider_position = None
+        self.unbuilt_layers = set()
+        if lazy_gcode is not None:
+            self.unbuilt_layers = set(range(len(self.actors)))
+            for actor in self.actors:
+                actor.VisibilityOff()
+            self.build_layer(0, lazy_gcode)
+            self.actors[0].VisibilityOn()
+            self.actors[0].GetProperty().SetColor(get_color(sett().colors.last_layer))
+            self.path_colors.apply(self.actors[0], last=True)
+            slider_position = 0
+
         if is_from_stl:
-            self.state_both(len(self.actors))
+            self.state_both(layers_count, slider_position)
         else:
-            self.state_gcode(len(self.actors))
+            self.state_gcode(layers_count, slider_position)
 
         # self.render.ResetCamera()
         self.reload_scene()
 
+    def start_gcode_preview(self):
+        # layers of G-code which is being sliced are added as they appear
+        for actor in self.actors:
+            self.render.RemoveActor(actor)
+        self.actors = []
+        self.layer_groups = None
+        self.unbuilt_layers = set()
+        self.path_colors.reset()  # ranges grow as layers are sliced
+        if self.stlActor:
+            self.stlActor.VisibilityOff()
+
+        self.picture_slider.setEnabled(False)
+        self.model_switch_box.setEnabled(False)
+        self.slice3a_button.setEnabled(False)
+        self.slice_vip_button.setEnabled(False)
+        for widget in self.preview_locked_widgets():
+            widget.setEnabled(False)
+        self.reload_scene()
+
+    def preview_locked_widgets(self):
+        # widgets which replace the scene or the model, they wait for slicing
+        return [
+            self.open_action,
+            self.load_sett_action,
+            self.save_project_action,
+            self.save_project_as_action,
+            self.save_gcode_action,
+            self.load_model_button,
+            self.save_gcode_button,
+            self.color_model_button,
+            self.move_button,
+            self.place_button,
+            self.bottom_panel,
+            self.cancel_action,
+            self.return_action,
+        ]
+
+    def finish_gcode_preview(self):
+        # menu actions are not covered by the states, which set the buttons
+        for action in (
+            self.open_action,
+            self.load_sett_action,
+            self.save_project_action,
+            self.save_project_as_action,
+            self.save_gcode_action,
+        ):
+            action.setEnabled(True)
+
+    def add_gcode_layers(self, actors):
+        if self.actors:
+            self.actors[-1].GetProperty().SetColor(get_color(sett().colors.layer))
+            self.actors[-1].GetProperty().SetOpacity(sett().common.opacity_layer)
+            self.path_colors.apply(self.actors[-1])
+        for actor in actors:
+            self.render.AddActor(actor)
+        self.actors.extend(actors)
+
+        self.layers_number_label.setText(str(len(self.actors)))
+        self.reload_scene()
+
+    def cancel_gcode_preview(self):
+        for actor in self.actors:
+            self.render.RemoveActor(actor)
+        self.actors = []
+        if self.stlActor:
+            self.stlActor.VisibilityOn()
+        self.finish_gcode_preview()
+        self.state_stl()
+        self.reload_scene()
+
+    def build_layer(self, layer, gcd):
+        if layer in self.unbuilt_layers:
+            self.unbuilt_layers.discard(layer)
+            block = self.actors[layer].GetMapper().GetInput()
+            gui_utils.fillBlock(block, gcd.layers[layer])
+            self.path_colors.fitBlock(block)
+
     def rotate_plane(self, tf):
         self.planeActor.SetUserTransform(tf)
         self.planeTransform = tf
@@ -955,7 +1125,10 @@ class MainWindow(QMainWindow):
         self.return_action.setEnabled(False)
         self.state = NothingState
 
-    def state_gcode(self, layers_count):
+    def state_gcode(self, layers_count, slider_position=None):
+        if slider_position is None:
+            slider_position = layers_count
+
         self.model_switch_box.setEnabled(False)
         self.model_switch_box.setChecked(False)
         self.model_centering_box.setEnabled(False)
@@ -965,7 +1138,7 @@ class MainWindow(QMainWindow):
         self.layers_number_label.setText(str(layers_count))
         self.picture_slider.setEnabled(True)
         self.picture_slider.setMaximum(layers_count)
-        self.picture_slider.setSliderPosition(layers_count)
+        self.picture_slider.setSliderPosition(slider_position)
         self.move_button.setEnabled(False)
         self.place_button.setEnabled(False)
         self.load_model_button.setEnabled(True)
@@ -1028,7 +1201,10 @@ class MainWindow(QMainWindow):
         self.return_action.setEnabled(True)
         self.state = MovingState
 
-    def state_both(self, layers_count):
+    def state_both(self, layers_count, slider_position=None):
+        if slider_position is None:
+            slider_position = layers_count
+
         self.model_switch_box.setEnabled(True)
         self.model_switch_box.setChecked(False)
         self.model_centering_box.setEnabled(False)
@@ -1038,7 +1214,7 @@ class MainWindow(QMainWindow):
         self.layers_number_label.setText(str(layers_count))
         self.picture_slider.setEnabled(True)
         self.picture_slider.setMaximum(layers_count)
-        self.picture_slider.setSliderPosition(layers_count)
+        self.picture_slider.setSliderPosition(slider_position)
         self.move_button.setEnabled(True)
         self.place_button.setEnabled(False)
         self.load_model_button.setEnabled(True)
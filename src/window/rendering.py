@@ -32,10 +32,12 @@ def init_3d_widget(window):
         window.interactor, window.render
     )
     window.interactor.AddObserver(
-        "MouseWheelBackwardEvent", window.customInteractor.middleBtnPress
+        "MouseWheelBackwardEvent",
+        lambda obj, event: window.customInteractor.middleBtnPress(obj, event, window),
     )
     window.interactor.AddObserver(
-        "MouseWheelForwardEvent", window.customInteractor.middleBtnPress
+        "MouseWheelForwardEvent",
+        lambda obj, event: window.customInteractor.middleBtnPress(obj, event, window),
     )
     window.interactor.AddObserver(
         "RightButtonPressEvent", window.customInteractor.rightBtnPress
@@ -62,6 +64,7 @@ def init_3d_widget(window):
     window.render.AddActor(window.planeActor)
 
     window.add_legend()
+    window.add_color_bar()
 
     window.splanes_actors = []
 
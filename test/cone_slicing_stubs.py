@@ -0,0 +1,10 @@
+import sys
+import types
+
+import gcode_stubs  # noqa: F401
+
+# Stubs for numpy-stl, slicing itself works on arrays of triangles
+
+stl_module = types.ModuleType("stl")
+stl_module.mesh = types.SimpleNamespace(Mesh=object)
+sys.modules.setdefault("stl", stl_module)
@@ -0,0 +1,186 @@
+import unittest
+
+import numpy as np
+
+import cone_slicing_stubs  # noqa: F401
+
+from src.cone_slicing import (
+    _cone_edges,
+    _cross_pairs,
+    adaptive_cone_heights,
+    cone_cross,
+    cone_heights,
+    cone_spans,
+    cross_cone_layers,
+    cross_cone_layers_parallel,
+    stitch_loops,
+)
+
+
+def onCone(points, angle, vertex):
+    # residual of the cone equation and whether points are below the vertex
+    radius = np.hypot(points[..., 0] - vertex[0], points[..., 1] - vertex[1])
+    depth = vertex[2] - points[..., 2]
+    return radius / np.tan(np.radians(angle)) - depth, depth >= -1e-9
+
+
+class TestConeSlicing(unittest.TestCase):
+    def testHorizontalTriangle(self):
+        triangles = np.array([[0, 0, 0, 20, 0, 0, 0, 20, 0]], dtype=np.float32)
+        layers = cross_cone_layers(triangles, 45, [0, 0, 0], [10, 30, -5])
+        self.assertEqual([1, 0, 0], [len(segments) for segments in layers])
+        ends = sorted(layers[0][0].tolist())
+        np.testing.assert_allclose([[0, 10, 0], [10, 0, 0]], ends, atol=1e-9)
+
+    def testPairing(self):
+        # a thin triangle crosses the circle twice on both sides of the vertex
+        triangles = np.array([[-20, -1, 0], [20, -1, 0], [0, 3, 0]])
+        (segments,) = cross_cone_layers(triangles, 45, [0, 0, 0], [10])
+        self.assertEqual(2, len(segments))
+        for segment in segments:
+            self.assertEqual(1, len(np.unique(np.sign(segment[:, 0]))))
+
+    def testRandomMesh(self):
+        rng = np.random.default_rng(1)
+        triangles = rng.uniform(-10, 10, (300, 3, 3))
+        vertex, angle = [1.0, -2.0, 0.0], 30
+        heights = np.linspace(-5, 15, 7)
+        layers = cross_cone_layers(triangles, angle, vertex, heights)
+
+        for height, segments in zip(heights, layers):
+            apex = [vertex[0], vertex[1], height]
+            residual, below = onCone(segments, angle, apex)
+            np.testing.assert_allclose(0, residual, atol=1e-6)
+            self.assertTrue(below.all())
+
+        # every crossing of an edge found by the scalar solver is an end of a segment
+        shifted = triangles - [vertex[0], vertex[1], 0]
+        height = heights[3]
+        ends = (layers[3] - [vertex[0], vertex[1], 0]).reshape(-1, 3)
+        for triangle in shifted:
+            for start, end in ((0, 1), (1, 2), (2, 0)):
+                found = cone_cross(
+                    triangle[start], triangle[end], angle, np.array([0, 0, height])
+                )
+                if found and not isinstance(found[0], list):
+                    distances = np.linalg.norm(ends - found, axis=1)
+                    self.assertLess(distances.min(), 1e-6)
+
+    def testCandidates(self):
+        # triangles out of their spans are skipped without losing segments
+        rng = np.random.default_rng(2)
+        triangles = rng.uniform(-10, 10, (200, 1, 3)) + rng.uniform(-1, 1, (200, 3, 3))
+        heights = rng.permutation(np.linspace(-12, 20, 33))
+        layers = cross_cone_layers(triangles, 60, [0.5, 0, 0], heights)
+
+        edges = _cone_edges(triangles, 60, [0.5, 0, 0])
+        tri_idx = np.tile(np.arange(len(triangles)), len(heights))
+        layer_idx = np.repeat(np.arange(len(heights)), len(triangles))
+        segments, pairs = _cross_pairs(edges, tri_idx, heights[layer_idx])
+        for layer, found in enumerate(layers):
+            expected = segments[layer_idx[pairs] == layer]
+            self.assertEqual(len(expected), len(found))
+            np.testing.assert_allclose(
+                np.sort(expected, axis=0), np.sort(found, axis=0)
+            )
+        self.assertGreater(sum(map(len, layers)), 0)
+
+    def testParallel(self):
+        rng = np.random.default_rng(3)
+        triangles = rng.uniform(-10, 10, (500, 1, 3)) + rng.uniform(-1, 1, (500, 3, 3))
+        triangles = triangles.astype(np.float32)
+        heights = np.linspace(-12, 20, 40)
+        expected = cross_cone_layers(triangles, 50, [0, 1, 0], heights)
+        layers = cross_cone_layers_parallel(
+            triangles, 50, [0, 1, 0], heights, processes=2, min_triangles=0
+        )
+        self.assertEqual(len(expected), len(layers))
+        for found, segments in zip(layers, expected):
+            np.testing.assert_array_equal(segments, found)
+
+    def testHeights(self):
+        # layers reach the top of the model whatever its height
+        triangles = np.array([[[0, 0, 0], [1, 0, 0], [0, 1, 250]]], dtype=np.float32)
+        heights = cone_heights(cone_spans(triangles, 90, [0, 0, 0]), 0, 0.2)
+        self.assertEqual(1251, len(heights))
+        self.assertAlmostEqual(250, heights[-1])
+
+        # a cone reaches higher than a plane by the radius
+        heights = cone_heights(cone_spans(triangles, 45, [0, 0, 0]), 0, 0.2)
+        self.assertAlmostEqual(251, heights[-1])
+        self.assertEqual(
+            0, len(cone_heights(cone_spans(triangles, 45, [0, 0, 0]), 300, 0.2))
+        )
+
+    def testAdaptiveHeights(self):
+        u, v = np.meshgrid(np.linspace(0, 2 * np.pi, 81), np.linspace(0, np.pi, 41))
+        sphere = np.stack([np.cos(u) * np.sin(v), np.sin(u) * np.sin(v), np.cos(v)], -1)
+        sphere = 10 * sphere + [0, 0, 10]
+        a, b, c, d = sphere[:-1, :-1], sphere[:-1, 1:], sphere[1:, 1:], sphere[1:, :-1]
+        triangles = np.concatenate(
+            [np.stack(q, -2).reshape(-1, 3, 3) for q in ((a, b, c), (a, c, d))]
+        )
+
+        heights = adaptive_cone_heights(triangles, 90, [0, 0, 0], 0.1, 0.3)
+        steps = np.diff(heights)
+        self.assertTrue(((steps > 0.1 - 1e-9) & (steps < 0.3 + 1e-9)).all())
+        self.assertGreater(heights[-1], 20 - 0.3)
+        self.assertLess(len(heights), 20 / 0.1)
+
+        # the poles are flat along the layers, the equator is across them
+        poles = steps[(heights[:-1] < 2) | (heights[:-1] > 18)]
+        equator = steps[np.abs(heights[:-1] - 10) < 2]
+        self.assertLess(poles.mean(), 0.15)
+        self.assertGreater(equator.mean(), 0.25)
+
+        # the layer normal of a cone is tilted, so walls are no longer across
+        tilted = adaptive_cone_heights(triangles, 45, [0, 0, 0], 0.1, 0.3)
+        self.assertNotEqual(len(heights), len(tilted))
+
+    def testStitchLoops(self):
+        # a square of shuffled and flipped segments and a separate open chain
+        square = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0], [0, 0, 0.0]])
+        segments = np.stack([square[:-1], square[1:]], axis=1)
+        segments[1] = segments[1, ::-1]
+        segments[2] += 1e-9
+        chain = np.array([[[5, 5, 0], [6, 5, 0]], [[7, 5, 0], [6, 5, 0]]])
+        segments = np.concatenate([segments[[2, 0, 3, 1]], chain])
+
+        loops, chains = stitch_loops(segments)
+        self.assertEqual(1, len(loops))
+        self.assertEqual((5, 3), loops[0].shape)
+        np.testing.assert_allclose(loops[0][0], loops[0][-1])
+        self.assertEqual(4, len(np.unique(loops[0].round(6), axis=0)))
+        self.assertEqual(1, len(chains))
+        self.assertEqual([5, 6, 7], sorted(chains[0][:, 0].tolist()))
+        self.assertEqual(6, chains[0][1, 0])
+
+    def testStitchCellBorder(self):
+        # ends of a pair may fall into neighbour cells of the hash grid
+        tolerance = 1e-3
+        points = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0]], dtype=np.float64)
+        segments = np.stack([points, np.roll(points, -1, axis=0)], axis=1)
+        segments[0, 0] = [-1e-7, 0, 0]
+        segments[2, 1] = [1e-7, 0, 0]
+        loops, chains = stitch_loops(segments, tolerance)
+        self.assertEqual([], chains)
+        self.assertEqual([4], [len(loop) for loop in loops])
+
+    def testSphereContours(self):
+        # a closed mesh gives closed contours
+        u, v = np.meshgrid(np.linspace(0, 2 * np.pi, 41), np.linspace(0, np.pi, 21))
+        sphere = np.stack([np.cos(u) * np.sin(v), np.sin(u) * np.sin(v), np.cos(v)], -1)
+        sphere = 10 * sphere + [0, 0, 10]
+        a, b, c, d = sphere[:-1, :-1], sphere[:-1, 1:], sphere[1:, 1:], sphere[1:, :-1]
+        triangles = np.concatenate(
+            [np.stack(q, -2).reshape(-1, 3, 3) for q in ((a, b, c), (a, c, d))]
+        )
+        for segments in cross_cone_layers(triangles, 45, [0, 0, 0], [5, 12.3, 19]):
+            loops, chains = stitch_loops(segments)
+            self.assertEqual([], chains)
+            self.assertEqual(1, len(loops))
+            self.assertEqual(len(segments) + 1, len(loops[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+Measure G-code loading speed in lines per second
+
+Usage: python test/gcode_benchmark.py [file.gcode]
+Without a file a reference print with travel moves and rotations is generated.
+The file is loaded the way the app does it when there is no sidecar yet, by
+readGCodeCached, and by readGCodeParallel with chunks small enough to use
+a process per CPU.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import gcode_stubs  # noqa: E402
+
+from src.gcode import cachePath, readGCodeCached, readGCodeParallel  # noqa: E402
+
+
+def writeReference(filename, layers=300, moves=300):
+    rnd = random.Random(0)
+    with open(filename, "w") as f:
+        f.write(";Estimated print time: 1000\nG90\nT0\nG92 E0\n")
+        e = 0.0
+        u = 0
+        for layer in range(layers):
+            f.write(";LAYER:%d\n" % layer)
+            if layer % 50 == 25:
+                u += 30
+                f.write("G0 U%d;rotation\n" % u)
+            for move in range(moves):
+                x, y = rnd.uniform(-50, 50), rnd.uniform(-50, 50)
+                z = layer * 0.2
+                if move % 10 == 0:
+                    f.write("G0 X%.3f Y%.3f Z%.3f F6000\n" % (x, y, z))
+                else:
+                    e += rnd.uniform(0.01, 0.1)
+                    f.write("G1 F1800 X%.3f Y%.3f Z%.3f E%.5f\n" % (x, y, z, e))
+        f.write(";End\n")
+
+
+def removeCache(filename):
+    if os.path.exists(cachePath(filename)):
+        os.remove(cachePath(filename))
+
+
+def loadCached(filename):
+    # every run misses the sidecar, it is removed before and after the load
+    removeCache(filename)
+    try:
+        readGCodeCached(filename, gcode_stubs.sett())
+    finally:
+        removeCache(filename)
+
+
+def loadParallel(filename):
+    readGCodeParallel(filename, settings=gcode_stubs.sett(), min_chunk_size=1 << 20)
+
+
+def benchmark(load, filename, repeat=5):
+    with open(filename, "rb") as f:
+        count = f.read().count(b"\n")
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        load(filename)
+        spent = time.perf_counter() - start
+        best = spent if best is None else min(best, spent)
+    return count, best
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        filename = os.path.join(tempfile.gettempdir(), "spycer_reference.gcode")
+        if not os.path.exists(filename):
+            writeReference(filename)
+
+    for name, load in (
+        ("readGCodeCached miss", loadCached),
+        ("readGCodeParallel", loadParallel),
+    ):
+        count, spent = benchmark(load, filename)
+        print(
+            "%s: %d lines in %.3f s, %.0f lines/s" % (name, count, spent, count / spent)
+        )
@@ -22,10 +22,20 @@ sys.modules["stk"] = types.ModuleType("stk")
 settings_module = types.ModuleType("src.settings")
 
 
+def _axes(linear, rotary, extruder):
+    return types.SimpleNamespace(
+        X=linear, Y=linear, Z=linear, U=rotary, V=rotary, E=extruder
+    )
+
+
 class _Hardware:
     rotation_center_x = 0
     rotation_center_y = 0
     rotation_center_z = 0
+    max_speed = _axes(2000, 500, 2000)
+    acceleration = _axes(800, 300, 1000)
+    max_jerk = _axes(200, 200, 120)
+    minimum_planner_speed = 0.05
 
 
 class _Slicing:
@@ -1,9 +1,31 @@
+import os
+import tempfile
 import unittest
+import unittest.mock
 import types
 
+import numpy as np
+
 import gcode_stubs  # noqa: F401
 
-from src.gcode import parseRotation, parseGCode, Printer
+from src.gcode import (
+    parseRotation,
+    parseValues,
+    parseGCode,
+    Printer,
+    GCodeTail,
+    LazyGCode,
+    PATH_EXTRUDE,
+    PATH_RETRACT,
+    PATH_TRAVEL,
+    cachePath,
+    readGCode,
+    readGCodeCached,
+    readGCodeLazy,
+    readGCodeParallel,
+    storeCache,
+    rotation_matrix,
+)
 
 
 def parseArgs(args, X, Y, Z, abs_pos=True):
@@ -54,6 +76,14 @@ class TestParseGCode(unittest.TestCase):
         self.assertEqual(3.3, parseRotation(["U3.3"]))
         self.assertEqual(-4.4, parseRotation(["V-4.4", ";other", "stuff"]))
 
+    def testParseValues(self):
+        self.assertEqual({}, parseValues(""))
+        self.assertEqual(
+            {"F": 1800.0, "X": 1.0, "Y": -2.5, "E": 0.1},
+            parseValues("F1800 X1 Y-2.5  E0.1"),
+        )
+        self.assertEqual({"Z": 2.22, "X": -1.0}, parseValues("Z+2.22 X-1"))
+
     def testParseGCode(self):
         gcode = [
             "G0 X0 Y0 Z0",
@@ -73,9 +103,460 @@ class TestParseGCode(unittest.TestCase):
         self.assertEqual([0, 0, 0, 1], result.lays2rots)
         first_path = [(p.x, p.y, p.z) for p in result.layers[0][0]]
         self.assertEqual([(0.0, 0.0, 0.0), (1.0, 0.0, 0.0)], first_path)
-        second_path = [(p.x, p.y, p.z) for p in result.layers[2][0]]
+        travel = [(p.x, p.y, p.z) for p in result.layers[2][0]]
+        self.assertEqual([(1.0, 0.0, 0.0), (0.0, 0.0, 0.0)], travel)
+        second_path = [(p.x, p.y, p.z) for p in result.layers[2][1]]
         self.assertEqual([(0.0, 0.0, 0.0), (1.0, 1.0, 0.0)], second_path)
 
+    def testColumnarLayout(self):
+        gcode = [
+            "G0 X0 Y0 Z0",
+            "G1 X1 Y0 Z0 E1",
+            "G1 X1 Y1 Z0 E2",
+            "G0 X5 Y5 Z0",
+            "G1 X6 Y5 Z0 E3",
+            ";LAYER:1",
+            "G1 X6 Y6 Z1 E4",
+            ";End",
+        ]
+        result = parseGCode(gcode, gcode_stubs.sett())
+        self.assertEqual((16, 3), result.points.shape)
+        self.assertEqual([0, 3, 5, 7, 10, 12, 14, 16], result.path_offsets.tolist())
+        self.assertEqual([0, 3, 6, 7, 7], result.layer_offsets.tolist())
+        self.assertEqual([0, 0, 0, 0], result.layer_rotations.tolist())
+        self.assertEqual([0, 1, 0, 0, 1, 0, 0], result.path_types.tolist())
+
+        points, offsets = result.layer_points(2)
+        self.assertEqual([[6, 5, 0], [6, 6, 1]], points.tolist())
+        self.assertEqual([0, 2], offsets.tolist())
+        self.assertEqual(0, len(result.layers[-1]))
+
+    def testPathTypes(self):
+        gcode = [
+            "G1 X1 Y0 Z0 E1",
+            "G1 E0.5",  # retraction
+            "G0 X5 Y5",
+            "G1 E1",
+            "G1 X6 Y5 E2",
+            ";LAYER:1",
+            "G0 X0 Y0",
+            "G1 X1 Y1 E3",
+            ";End",
+        ]
+        result = parseGCode(gcode, gcode_stubs.sett())
+        self.assertEqual(
+            [PATH_EXTRUDE, PATH_RETRACT, PATH_EXTRUDE],
+            result.layer_path_types(0).tolist(),
+        )
+        self.assertEqual(
+            [PATH_TRAVEL, PATH_EXTRUDE], result.layer_path_types(2).tolist()
+        )
+        points, offsets = result.layer_points(2)
+        self.assertEqual([[6, 5, 0], [0, 0, 0]], points[: offsets[1]].tolist())
+        self.assertEqual(0, len(result.layer_path_types(3)))
+
+    def testPathStats(self):
+        gcode = [
+            "G1 F600 X10 Y0 Z0 E1",
+            "G1 X20 Y0 E2",
+            "G1 X30 Y0 E4",  # twice the flow starts a new path
+            "G1 F1200 X40 Y0 E5",  # and so does another feed
+            "G0 X40 Y10",
+            ";End",
+        ]
+        result = parseGCode(gcode, gcode_stubs.sett())
+        self.assertEqual([0, 3, 5, 7, 9], result.layer_points(0)[1].tolist())
+        np.testing.assert_allclose([10, 10, 20, 20], result.layer_path_stats(0)[:, 0])
+        np.testing.assert_allclose([0.1, 0.2, 0.1, 0], result.layer_path_stats(0)[:, 1])
+        np.testing.assert_allclose(result.path_feed, result.path_stats[:, 0])
+
+        layer = result.layers[0]
+        np.testing.assert_allclose(result.layer_path_stats(0), layer.path_stats)
+        self.assertEqual(result.layer_time[0], layer.time)
+
+    def testLayerStats(self):
+        gcode = [
+            "G1 F600 X10 Y0 Z0 E1",
+            ";LAYER:1",
+            "G0 X10 Y10",
+            "G1 X0 Y10 E3",
+            ";LAYER:2",
+            "G0 X0 Y0",  # travel of the empty layer goes to the next one
+            ";LAYER:3",
+            "G1 X10 Y0 E4",
+            "G0 U30;rotation",
+            ";End",
+        ]
+        result = parseGCode(gcode, gcode_stubs.sett())
+        self.assertEqual([0, 0, 0, 0, 1], result.lays2rots)
+        self.assertEqual([10, 0, 10, 10, 0], result.layer_extrusion.tolist())
+        self.assertEqual([0, 0, 10, 10, 0], result.layer_travel.tolist())
+        self.assertEqual([1, 0, 2, 1, 0], result.layer_consumption.tolist())
+
+        # 10 mm/s feed is reached after 0.1 mm of acceleration from the jerk speed
+        jerk, acceleration = 200 / 60, 800
+        ramp = (10**2 - jerk**2) / acceleration
+        first = 2 * (10 - jerk) / acceleration + (10 - ramp) / 10
+        self.assertAlmostEqual(first, result.layer_time[0])
+        self.assertEqual(0, result.layer_time[1])
+        self.assertTrue(all(result.layer_time[2:4] > 1))
+        self.assertEqual(0, result.layer_time[4])  # the rotation does not move
+
+    def testConePath(self):
+        gcode = ["G0 X0 Y10 Z5 U0", "G1 X0 Y10 Z5 U12 E1", ";End"]
+        result = parseGCode(gcode, gcode_stubs.sett())
+        points, offsets = result.layer_points(0)
+        points = points[offsets[1] :]  # skip the travel to the start
+
+        # U step of 12 degrees is split into three parts of 4 degrees
+        self.assertEqual(4, len(points))
+        for u, point in zip([0, 4, 8, 12], points):
+            expected = rotation_matrix([0, 0, 1], -np.radians(u)).dot([0, 10, 5])
+            np.testing.assert_allclose(expected, point, atol=1e-9)
+
+    def testConePathSplit(self):
+        # a flow change splits a cone extrusion which starts flat, both paths
+        # are still converted and join without a gap
+        gcode = ["G0 U30;rotation", "G1 X16 Y8 E1.862", "G1 X19 Y3 U42 E2.315"]
+        result = parseGCode(gcode + [";End"], gcode_stubs.sett())
+        points, offsets = result.layer_points(1)
+        self.assertEqual(3, len(offsets))
+        np.testing.assert_allclose(points[offsets[1] - 1], points[offsets[1]])
+
+        with unittest.mock.patch("src.gcode.FLOW_TOLERANCE", np.inf):
+            whole = parseGCode(gcode + [";End"], gcode_stubs.sett())
+        expected, _ = whole.layer_points(1)
+        np.testing.assert_allclose(expected, np.delete(points, offsets[1], axis=0))
+
+    def testParallel(self):
+        gcode = ["G90"]
+        for layer in range(12):
+            gcode.append(";LAYER:%d" % layer)
+            if layer == 4:
+                gcode.append("G0 U30;rotation")
+            if layer == 8:
+                gcode.append("G0 V15;incline")
+            gcode.append("G0 X0 Y0 Z%d" % layer)
+            if layer == 2:
+                gcode.append("G1 F1200")  # the feed rate is carried over layers
+            gcode.append(
+                "G1 X5 Y1 Z%d U%d E%d" % (layer, 30 if layer >= 4 else 0, layer)
+            )
+            gcode.append("G1 X5 Y5 E%d.5" % layer)
+            if layer == 5:
+                gcode.append("G1 E4")  # the next layer starts retracted
+        gcode.append(";End")
+
+        with tempfile.NamedTemporaryFile("w", suffix=".gcode", delete=False) as f:
+            f.write("\n".join(gcode))
+        try:
+            expected = readGCode(f.name, gcode_stubs.sett())
+            result = readGCodeParallel(
+                f.name, processes=3, settings=gcode_stubs.sett(), min_chunk_size=64
+            )
+        finally:
+            os.unlink(f.name)
+
+        self.assertEqual(expected.path_offsets.tolist(), result.path_offsets.tolist())
+        self.assertEqual(expected.layer_offsets.tolist(), result.layer_offsets.tolist())
+        self.assertEqual(expected.lays2rots, result.lays2rots)
+        self.assertEqual(
+            [(r.x_rot, r.z_rot) for r in expected.rotations],
+            [(r.x_rot, r.z_rot) for r in result.rotations],
+        )
+        self.assertEqual(expected.path_types.tolist(), result.path_types.tolist())
+        np.testing.assert_allclose(expected.path_stats, result.path_stats)
+        self.assertIn(PATH_RETRACT, result.path_types)
+        np.testing.assert_allclose(expected.points, result.points)
+        np.testing.assert_allclose(expected.layer_stats, result.layer_stats)
+
+    def testProgress(self):
+        gcode = ["G90"]
+        for layer in range(20):
+            gcode.append(";LAYER:%d" % layer)
+            gcode.append("G1 X5 Y%d Z%d E%d" % (layer, layer, layer + 1))
+        gcode.append(";End")
+
+        with tempfile.NamedTemporaryFile("w", suffix=".gcode", delete=False) as f:
+            f.write("\n".join(gcode))
+        try:
+            size = os.path.getsize(f.name)
+            offsets = []
+            with unittest.mock.patch("src.gcode.REPORT_SIZE", 64):
+                readGCode(f.name, gcode_stubs.sett(), offsets.append)
+            self.assertGreater(len(offsets), 2)
+            self.assertEqual(sorted(offsets), offsets)
+            self.assertLessEqual(offsets[-1], size)
+
+            # chunks of parallel parsing are reported as they are merged
+            chunks = []
+            readGCodeParallel(
+                f.name,
+                processes=2,
+                settings=gcode_stubs.sett(),
+                min_chunk_size=64,
+                report=chunks.append,
+            )
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(sorted(chunks), chunks)
+            self.assertEqual(size - len(";End"), chunks[-1])
+        finally:
+            os.unlink(f.name)
+
+    def testCache(self):
+        gcode = [
+            ";Estimated print time: 120.5",
+            "G1 X1 Y0 Z0 E1",
+            ";LAYER:1",
+            "G1 X1 Y1 Z1 U20 E2",
+            ";End",
+        ]
+        parsed = []
+
+        def reader(filename, settings, report=None):
+            parsed.append(filename)
+            return readGCode(filename, settings)
+
+        settings = gcode_stubs.sett()
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "out.gcodevis")
+            with open(filename, "w") as f:
+                f.write("\n".join(gcode))
+
+            expected = readGCodeCached(filename, settings, reader)
+            self.assertTrue(os.path.exists(cachePath(filename)))
+
+            settings.slicing.print_time = 0
+            result = readGCodeCached(filename, settings, reader)
+            self.assertEqual(1, len(parsed))
+            self.assertEqual(120.5, settings.slicing.print_time)
+            np.testing.assert_array_equal(expected.points, result.points)
+            np.testing.assert_array_equal(expected.layer_stats, result.layer_stats)
+            np.testing.assert_array_equal(expected.path_types, result.path_types)
+            np.testing.assert_array_equal(expected.path_stats, result.path_stats)
+            self.assertEqual(expected.lays2rots, result.lays2rots)
+            self.assertEqual(
+                expected.layer_offsets.tolist(), result.layer_offsets.tolist()
+            )
+            self.assertEqual(
+                [(r.x_rot, r.z_rot) for r in expected.rotations],
+                [(r.x_rot, r.z_rot) for r in result.rotations],
+            )
+
+            # another rotation center changes cone geometry
+            settings.hardware.rotation_center_x = 5
+            try:
+                readGCodeCached(filename, settings, reader)
+            finally:
+                settings.hardware.rotation_center_x = 0
+            self.assertEqual(2, len(parsed))
+
+            with open(filename, "a") as f:
+                f.write("\n")
+            readGCodeCached(filename, settings, reader)
+            self.assertEqual(3, len(parsed))
+
+    def testLazy(self):
+        gcode = ["G90", "G1 X1 Y0 Z0 E1"]
+        for layer in range(6):
+            gcode.append(";LAYER:%d" % layer)
+            if layer == 3:
+                gcode.append("G0 U30;rotation")
+            gcode.append("G0 X0 Y0 Z%d" % layer)
+            gcode.append("G1 X5 Y%d Z%d E%d" % (layer, layer, layer + 2))
+        gcode.append(";End")
+
+        with tempfile.NamedTemporaryFile("w", suffix=".gcode", delete=False) as f:
+            f.write("\n".join(gcode))
+        try:
+            expected = readGCode(f.name, gcode_stubs.sett())
+            lazy = LazyGCode(f.name, gcode_stubs.sett(), prefetch=2)
+            try:
+                self.assertEqual(expected.lays2rots, lazy.lays2rots)
+                self.assertEqual(len(expected.layers), len(lazy.layers))
+
+                points, offsets = lazy.layer_points(2)
+                self.assertEqual([1, 2, 3], sorted(lazy.futures))
+                self.assertEqual([0, 2, 4], offsets.tolist())
+                for idx in range(len(lazy.layers)):
+                    points, offsets = lazy.layer_points(idx)
+                    expected_points, expected_offsets = expected.layer_points(idx)
+                    self.assertEqual(expected_offsets.tolist(), offsets.tolist())
+                    np.testing.assert_array_equal(expected_points, points)
+                    np.testing.assert_array_equal(
+                        expected.layer_path_types(idx), lazy.layer_path_types(idx)
+                    )
+                    np.testing.assert_allclose(
+                        expected.layer_path_stats(idx), lazy.layer_path_stats(idx)
+                    )
+            finally:
+                lazy.close()
+
+            small = readGCodeLazy(f.name, gcode_stubs.sett(), min_layers=100)
+            self.assertNotIsInstance(small, LazyGCode)
+            self.assertEqual(expected.lays2rots, small.lays2rots)
+            large = readGCodeLazy(f.name, gcode_stubs.sett(), min_layers=2)
+            self.assertIsInstance(large, LazyGCode)
+            large.close()
+
+            def reader(filename, settings, report=None):
+                return readGCodeLazy(filename, settings, min_layers=2)
+
+            # lazily parsed files are neither hashed nor stored
+            with unittest.mock.patch("src.gcode.cacheKey") as key:
+                readGCodeCached(f.name, gcode_stubs.sett(), reader).close()
+            key.assert_not_called()
+            self.assertFalse(os.path.exists(cachePath(f.name)))
+
+            # but the sidecar of an eager parse is used by the next loads
+            storeCache(expected, f.name, gcode_stubs.sett())
+            cached = readGCodeCached(f.name, gcode_stubs.sett(), reader)
+            self.assertNotIsInstance(cached, LazyGCode)
+            self.assertEqual(expected.lays2rots, cached.lays2rots)
+            np.testing.assert_array_equal(expected.points, cached.points)
+
+            with open(f.name, "a") as out:
+                out.write("\n")
+            readGCodeCached(f.name, gcode_stubs.sett(), reader).close()
+            self.assertFalse(os.path.exists(cachePath(f.name)))
+        finally:
+            os.unlink(f.name)
+            if os.path.exists(cachePath(f.name)):
+                os.unlink(cachePath(f.name))
+
+    def testLazyLayers(self):
+        # empty layers and rotations in the middle of layers give the same
+        # layer boundaries as eager parsing
+        gcode = ["G90", "G0 X0 Y0 Z0"]
+        for layer in range(8):
+            gcode.append(";LAYER:%d" % layer)
+            gcode.append("G0 X0 Y0 Z%d" % layer)
+            if layer in (2, 5):
+                gcode.append("G0 X3 Y3 Z%d" % layer)  # nothing is printed
+                continue
+            gcode.append("G1 X5 Y%d Z%d E%d" % (layer, layer, 2 * layer + 1))
+            if layer == 3:
+                gcode.append("G0 U30;rotation")
+                gcode.append("G1 X1 Y1 Z%d U30 E%d.5" % (layer, 2 * layer + 1))
+            if layer == 6:
+                gcode.append("G0 V15;incline")
+                gcode.append("G0 X2 Y2 Z%d" % layer)  # ends the layer empty
+        gcode.append(";End")
+
+        with tempfile.NamedTemporaryFile("w", suffix=".gcode", delete=False) as f:
+            f.write("\n".join(gcode))
+        try:
+            expected = readGCode(f.name, gcode_stubs.sett())
+            lazy = LazyGCode(f.name, gcode_stubs.sett())
+            try:
+                self.assertEqual(len(expected.layers), len(lazy.layers))
+                self.assertEqual(expected.lays2rots, lazy.lays2rots)
+                for idx in range(len(lazy.layers)):
+                    points, offsets = lazy.layer_points(idx)
+                    expected_points, expected_offsets = expected.layer_points(idx)
+                    self.assertEqual(expected_offsets.tolist(), offsets.tolist())
+                    np.testing.assert_allclose(expected_points, points)
+                    np.testing.assert_array_equal(
+                        expected.layer_path_types(idx), lazy.layer_path_types(idx)
+                    )
+            finally:
+                lazy.close()
+
+            parallel = readGCodeParallel(
+                f.name, processes=3, settings=gcode_stubs.sett(), min_chunk_size=16
+            )
+            self.assertEqual(expected.lays2rots, parallel.lays2rots)
+            np.testing.assert_allclose(expected.points, parallel.points)
+        finally:
+            os.unlink(f.name)
+
+    def testTail(self):
+        gcode = [
+            "G1 X1 Y0 Z0 E1",
+            ";LAYER:1",
+            "G0 X0 Y0 Z1",
+            "G1 X1 Y1 Z1 E2",
+            ";LAYER:2",
+            "G1 X2 Y2 Z1 E3",
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "out.gcodevis")
+            tail = GCodeTail(filename, gcode_stubs.sett())
+            self.assertEqual([], tail.poll())  # the slicer has not started yet
+
+            with open(filename, "w") as f:
+                f.write("\n".join(gcode[:3]) + "\nG1 X1 Y1")
+            layers = tail.poll()
+            self.assertEqual([0, 0], [rotation for _, rotation in layers])
+            self.assertEqual([[0, 0, 0], [1, 0, 0]], layers[0][0].points.tolist())
+
+            with open(filename, "a") as f:
+                f.write(" Z1 E2\n" + "\n".join(gcode[4:]))
+            layers = tail.poll()
+            self.assertEqual(1, len(layers))
+            layer = layers[0][0]
+            self.assertEqual([PATH_TRAVEL, PATH_EXTRUDE], layer.path_types.tolist())
+            self.assertEqual(
+                [[1, 0, 0], [0, 0, 1], [0, 0, 1], [1, 1, 1]], layer.points.tolist()
+            )
+
+            result = tail.finish()
+        expected = parseGCode(gcode, gcode_stubs.sett())
+        self.assertEqual(expected.lays2rots, result.lays2rots)
+        self.assertEqual(expected.layer_offsets.tolist(), result.layer_offsets.tolist())
+        np.testing.assert_array_equal(expected.points, result.points)
+        np.testing.assert_allclose(expected.layer_stats, result.layer_stats)
+
+    def testTailReadSize(self):
+        gcode = ["G1 X1 Y0 Z0 E1", ";LAYER:1", "G0 X0 Y0 Z1", "G1 X1 Y1 Z1 E2", ";End"]
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "out.gcodevis")
+            with open(filename, "w") as f:
+                f.write("\n".join(gcode) + "\n")
+
+            # a poll reads a bounded part of the file and tells when it is done
+            tail = GCodeTail(filename, gcode_stubs.sett())
+            polls = 0
+            layers = tail.poll(max_bytes=8)
+            while not tail.caught_up:
+                layers += tail.poll(max_bytes=8)
+                polls += 1
+            self.assertGreater(polls, 5)
+            self.assertEqual(2, len(layers))
+
+            # finish reads everything left
+            tail = GCodeTail(filename, gcode_stubs.sett())
+            tail.poll(max_bytes=8)
+            result = tail.finish()
+        expected = parseGCode(gcode, gcode_stubs.sett())
+        self.assertEqual(expected.lays2rots, result.lays2rots)
+        np.testing.assert_array_equal(expected.points, result.points)
+
+    def testMapped(self):
+        gcode = [
+            ";G0 U10;rotation-hack",
+            "G1 X1 Y0 Z0 E1",
+            "G1 X2 Y1 Z0 E2 ;comment",
+            ";LAYER:1",
+            "G1 F1800 X2 Y2 Z1 E3",
+            "G1 X3 Y2 Z1 U20 E4",
+            ";End",
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "out.gcode")
+            with open(filename, "w", newline="") as f:
+                f.write("\r\n".join(gcode))
+            result = readGCode(filename, gcode_stubs.sett())
+
+            open(filename, "w").close()
+            empty = readGCode(filename, gcode_stubs.sett())
+            self.assertEqual([0, 0], empty.lays2rots)
+
+        expected = parseGCode(gcode, gcode_stubs.sett())
+        self.assertEqual(expected.lays2rots, result.lays2rots)
+        self.assertEqual(expected.path_offsets.tolist(), result.path_offsets.tolist())
+        np.testing.assert_array_equal(expected.points, result.points)
+
 
 if __name__ == "__main__":
     unittest.main()
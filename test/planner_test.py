@@ -0,0 +1,133 @@
+import math
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import gcode_stubs
+
+from src.gcode import readMoves
+from src.planner import estimatePrintTime, planMoves
+
+HARDWARE = gcode_stubs.sett().hardware
+SPEED, ACCELERATION, JERK = 2000 / 60, 800, 200 / 60
+
+
+def trapezoid(length, speed, acceleration, entry, exit):
+    cruise = length - (2 * speed**2 - entry**2 - exit**2) / (2 * acceleration)
+    if cruise < 0:
+        speed = math.sqrt((2 * acceleration * length + entry**2 + exit**2) / 2)
+        cruise = 0
+    return (2 * speed - entry - exit) / acceleration + cruise / speed
+
+
+def planSequentially(deltas, feeds):
+    """Straightforward planner of XY moves with the same limits as planMoves"""
+    lengths = [math.hypot(dx, dy) for dx, dy in deltas[:, :2]]
+    directions = [d[:2] / length for d, length in zip(deltas, lengths)]
+    speeds = [min(f, SPEED / max(abs(d))) for f, d in zip(feeds, directions)]
+    accelerations = [ACCELERATION / max(abs(d)) for d in directions]
+
+    zero = np.zeros(2)
+    junctions = []
+    for k in range(len(deltas) + 1):
+        before = directions[k - 1] if k > 0 else zero
+        after = directions[k] if k < len(deltas) else zero
+        jump = abs(after - before)
+        speed = min(JERK / j for j in jump if j > 0)
+        speed = max(speed, HARDWARE.minimum_planner_speed)
+        if k > 0:
+            speed = min(speed, speeds[k - 1])
+        if k < len(deltas):
+            speed = min(speed, speeds[k])
+        junctions.append(speed)
+
+    for k in range(len(deltas) - 1, -1, -1):
+        reach = 2 * accelerations[k] * lengths[k]
+        junctions[k] = min(junctions[k], math.sqrt(junctions[k + 1] ** 2 + reach))
+    for k in range(len(deltas)):
+        reach = 2 * accelerations[k] * lengths[k]
+        junctions[k + 1] = min(junctions[k + 1], math.sqrt(junctions[k] ** 2 + reach))
+
+    return [
+        trapezoid(
+            lengths[k], speeds[k], accelerations[k], junctions[k], junctions[k + 1]
+        )
+        for k in range(len(deltas))
+    ]
+
+
+def moves(*rows):
+    deltas = np.zeros((len(rows), 6))
+    for i, row in enumerate(rows):
+        deltas[i, : len(row)] = row
+    return deltas
+
+
+class TestPlanner(unittest.TestCase):
+    def testSingleMove(self):
+        durations = planMoves(moves((100,)), [np.nan], HARDWARE)
+        expected = trapezoid(100, SPEED, ACCELERATION, JERK, JERK)
+        self.assertAlmostEqual(expected, durations[0])
+
+        # too short to reach the feed rate
+        durations = planMoves(moves((0.1,)), [10], HARDWARE)
+        self.assertAlmostEqual(
+            trapezoid(0.1, 10, ACCELERATION, JERK, JERK), durations[0]
+        )
+
+    def testJunctions(self):
+        straight = planMoves(moves((100,)), [20], HARDWARE).sum()
+        split = planMoves(moves((50,), (50,)), [20, 20], HARDWARE).sum()
+        corner = planMoves(moves((50,), (0, 50)), [20, 20], HARDWARE).sum()
+        self.assertAlmostEqual(straight, split)
+        self.assertGreater(corner, straight)
+
+    def testLookAhead(self):
+        rnd = np.random.default_rng(0)
+        deltas = moves(*rnd.uniform(-5, 5, (500, 2)))
+        deltas[::7, :2] *= 0.01  # short segments which limit their neighbours
+        feeds = rnd.choice([10, 30, 60], len(deltas))
+        np.testing.assert_allclose(
+            planSequentially(deltas, feeds), planMoves(deltas, feeds, HARDWARE)
+        )
+
+    def testAxes(self):
+        # the rotation is limited by U and the retraction by E
+        rotation = planMoves(moves((0, 0, 0, 90)), [np.nan], HARDWARE)
+        self.assertAlmostEqual(
+            trapezoid(90, 500 / 60, 300, 200 / 60, 200 / 60), rotation[0]
+        )
+        retraction = planMoves(moves((0, 0, 0, 0, 0, -2)), [np.nan], HARDWARE)
+        self.assertAlmostEqual(trapezoid(2, 2000 / 60, 1000, 2, 2), retraction[0])
+
+        self.assertEqual([0], planMoves(moves(()), [np.nan], HARDWARE).tolist())
+
+    def testReadMoves(self):
+        gcode = [
+            "G1 F1200 X10 Y0 Z0 E1",
+            "G92 E0",
+            ";LAYER:1",
+            "G0 U30;rotation",
+            "G1 F600",
+            "G1 X10 Y5 E1",
+            ";End",
+        ]
+        with tempfile.NamedTemporaryFile("w", suffix=".gcode", delete=False) as f:
+            f.write("\n".join(gcode))
+        try:
+            deltas, feeds = readMoves(f.name, gcode_stubs.sett())
+            total, durations = estimatePrintTime(f.name, gcode_stubs.sett())
+        finally:
+            os.unlink(f.name)
+
+        expected = [[10, 0, 0, 0, 0, 1], [0, 0, 0, 30, 0, 0], [0, 5, 0, 0, 0, 1]]
+        self.assertEqual(expected, deltas.tolist())
+        self.assertEqual([20, 20, 10], feeds.tolist())
+        self.assertEqual(3, len(durations))
+        self.assertAlmostEqual(durations.sum(), total)
+
+
+if __name__ == "__main__":
+    unittest.main()